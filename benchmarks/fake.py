@@ -0,0 +1,249 @@
+import random
+import asyncio
+import itertools
+from types import SimpleNamespace
+from pyrogram.enums import MessageMediaType
+from pyrogram.errors import FloodWait, UserIsBlocked
+
+# stream_media yields 1 MB chunks, like pyrogram
+CHUNK = 1024 * 1024
+ZERO = bytes(CHUNK)
+
+
+class Link:
+    # Simulated Telegram link: every request pays `latency` and every byte
+    # `1 / bandwidth`. Rate limited calls (message copies and edits, upload
+    # parts) hit a FloodWait of `flood_wait` seconds with probability
+    # `flood_rate`; like pyrogram, waits up to `sleep_threshold` are slept
+    # through and longer ones raised.
+
+    def __init__(self, bandwidth=50 * CHUNK, latency=0.02, flood_rate=0.0, flood_wait=1, sleep_threshold=5):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.sleep_threshold = sleep_threshold
+        self.requests = 0
+        self.bytes = 0
+        self.flood_waits = 0
+
+    async def request(self, size=0, limited=False):
+        self.requests += 1
+        self.bytes += size
+        if limited and self.flood_rate and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            if self.flood_wait > self.sleep_threshold:
+                raise FloodWait(value=self.flood_wait)
+            await asyncio.sleep(self.flood_wait)
+        await asyncio.sleep(self.latency + size / self.bandwidth)
+
+
+class FakeMessage:
+
+    def __init__(self, client, chat_id, id, text=None, media=None, file=None, reply_to_message=None, reply_markup=None):
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=chat_id, mention=f"user{chat_id}")
+        self.id = id
+        self.text = text
+        self.caption = None
+        self.media = media
+        self.reply_to_message = reply_to_message
+        self.reply_markup = reply_markup
+        self.empty = False
+        self.command = text.split() if text and text.startswith("/") else []
+        self.document = self.video = self.audio = None
+        if media is not None:
+            setattr(self, media.value, file)
+
+    async def reply_text(self, text, reply_to_message_id=None, reply_markup=None, quote=None, **kwargs):
+        reply_to = self._client.lookup(self.chat.id, reply_to_message_id) if reply_to_message_id else (self if quote else None)
+        return await self._client.send_message(self.chat.id, text, reply_to_message=reply_to, reply_markup=reply_markup)
+
+    async def reply_photo(self, photo, caption=None, reply_markup=None, **kwargs):
+        return await self.reply_text(caption, reply_markup=reply_markup)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await self._client.link.request(limited=True)
+        self.text = text
+        self.reply_markup = reply_markup
+        self._client.edits += 1
+        return self
+
+    async def edit(self, text, reply_markup=None, **kwargs):
+        return await self.edit_text(text, reply_markup=reply_markup)
+
+    async def delete(self):
+        await self._client.link.request()
+        self._client.forget(self.chat.id, self.id)
+
+    async def copy(self, chat_id, **kwargs):
+        # Broadcast target; ids in client.blocked have blocked the bot
+        await self._client.link.request(limited=True)
+        if chat_id in self._client.blocked:
+            raise UserIsBlocked()
+        self._client.copies += 1
+        return await self._client.send_message(chat_id, self.text)
+
+
+class FakeQuery:
+
+    def __init__(self, message, data, user_id):
+        self.message = message
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.matches = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeSession:
+    # One media connection. Requests on it are pipelined, so their latency
+    # overlaps, but their bytes share the connection's bandwidth.
+
+    def __init__(self, link):
+        self.link = link
+        self._wire = asyncio.Lock()
+
+    async def invoke(self, query):
+        size = len(getattr(query, "bytes", b""))
+        async with self._wire:
+            await asyncio.sleep(size / self.link.bandwidth)
+        self.link.bytes += size
+        await self.link.request(limited=True)
+
+    async def stop(self):
+        pass
+
+
+class FakeClient:
+    # Just enough of pyrogram.Client for the rename, /start and broadcast
+    # handlers. Messages live in an in-memory store so get_messages and
+    # replies see each other; every call goes through the simulated link.
+
+    def __init__(self, link=None):
+        self.link = link or Link()
+        self.force_channel = None
+        self.blocked = set()
+        self.edits = 0
+        self.copies = 0
+        self.sent_files = 0
+        self.streams = 0
+        self._messages = {}
+        self._ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        # message id of a user's file -> Event set when its renamed copy arrives
+        self.delivered = {}
+        # message id -> latest bot message replying to it
+        self.replies = {}
+
+    def clone(self, link=None):
+        # Another process (worker.py) of the same bot: own link, same chats
+        other = FakeClient(link or Link(self.link.bandwidth, self.link.latency, self.link.flood_rate, self.link.flood_wait))
+        other._messages, other._ids, other._file_ids = self._messages, self._ids, self._file_ids
+        other.delivered, other.replies = self.delivered, self.replies
+        return other
+
+    def rnd_id(self):
+        return random.randint(-2 ** 63, 2 ** 63 - 1)
+
+    def lookup(self, chat_id, message_id):
+        return self._messages.get((chat_id, message_id))
+
+    def forget(self, chat_id, message_id):
+        self._messages.pop((chat_id, message_id), None)
+
+    def _store(self, message):
+        self._messages[(message.chat.id, message.id)] = message
+        return message
+
+    def new_file(self, user_id, kind="document", size=20 * CHUNK, name=None, unique_id=None):
+        # A file message as the user would send it
+        n = next(self._file_ids)
+        file = SimpleNamespace(
+            file_id=f"file{n}",
+            file_unique_id=unique_id or f"unique{n}",
+            file_name=name or f"Some.Show.S01E{n:02}.720p.{'mp4' if kind == 'video' else 'mkv'}",
+            file_size=size,
+            mime_type="video/mp4" if kind == "video" else "application/octet-stream",
+            width=1280 if kind == "video" else None,
+            height=720 if kind == "video" else None,
+            duration=1440 if kind in ("video", "audio") else None
+        )
+        media = {"document": MessageMediaType.DOCUMENT, "video": MessageMediaType.VIDEO, "audio": MessageMediaType.AUDIO}[kind]
+        message = self._store(FakeMessage(self, user_id, next(self._ids), media=media, file=file))
+        self.delivered[message.id] = asyncio.Event()
+        return message
+
+    def user_message(self, user_id, text, reply_to_message=None):
+        return self._store(FakeMessage(self, user_id, next(self._ids), text=text, reply_to_message=reply_to_message))
+
+    async def send_message(self, chat_id, text, reply_to_message=None, reply_markup=None):
+        await self.link.request()
+        message = self._store(FakeMessage(self, chat_id, next(self._ids), text=text, reply_to_message=reply_to_message, reply_markup=reply_markup))
+        if reply_to_message is not None:
+            self.replies[reply_to_message.id] = message
+        return message
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.link.request()
+        message = self.lookup(chat_id, message_ids)
+        if message is None:
+            message = FakeMessage(self, chat_id, message_ids)
+            message.empty = True
+        return message
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        message = self.lookup(chat_id, message_id)
+        if message is not None:
+            await message.edit_text(text)
+
+    async def stream_media(self, message, limit=0, offset=0):
+        self.streams += 1
+        size = getattr(message, message.media.value).file_size
+        chunks = -(-size // CHUNK)
+        end = min(chunks, offset + limit) if limit else chunks
+        for i in range(offset, end):
+            length = min(CHUNK, size - i * CHUNK)
+            await self.link.request(length)
+            yield ZERO[:length]
+
+    async def download_media(self, message, file_name, progress=None, progress_args=()):
+        size = getattr(message, message.media.value).file_size
+        done = 0
+        with open(file_name, "wb") as f:
+            async for chunk in self.stream_media(message):
+                f.write(chunk)
+                done += len(chunk)
+                if progress:
+                    await progress(done, size, *progress_args)
+        return file_name
+
+    async def send_cached_media(self, chat_id, file_id, caption=None, reply_to_message_id=None, **kwargs):
+        await self.link.request()
+        self._deliver(reply_to_message_id)
+
+    async def upload_result(self, chat_id, kind, file_name, reply_to_message_id=None):
+        await self.link.request()
+        media = {"document": MessageMediaType.DOCUMENT, "video": MessageMediaType.VIDEO, "audio": MessageMediaType.AUDIO}[kind]
+        n = next(self._file_ids)
+        result = SimpleNamespace(file_id=f"renamed{n}", file_unique_id=f"renamed{n}", file_name=file_name)
+        self.sent_files += 1
+        self._deliver(reply_to_message_id)
+        return FakeMessage(self, chat_id, next(self._ids), media=media, file=result)
+
+    def _deliver(self, message_id):
+        event = self.delivered.get(message_id)
+        if event is not None:
+            event.set()
+
+
+async def media_session(client):
+    # Replaces helper.transfer._media_session
+    return FakeSession(client.link)
+
+
+async def send_uploaded(client, chat_id, kind, file, file_name, reply_to_message_id=None, **kwargs):
+    # Replaces send_uploaded in plugins.cb_data, which parses a real MTProto reply
+    return await client.upload_result(chat_id, kind, file_name, reply_to_message_id)
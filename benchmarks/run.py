@@ -0,0 +1,562 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+from benchmarks.fake import CHUNK, Link, FakeClient, FakeQuery
+
+# Offline benchmark / load test. Drives the real handlers of plugins/ with a
+# FakeClient (simulated Telegram link) and mongomock-motor, or a real mongod
+# with --mongo. Run from the repo root:
+#
+#   python -m benchmarks.run rename --users 20 --files 3 --size 20
+#   python -m benchmarks.run all --json results.json
+#   python -m benchmarks.run all --compare results.json   # exit 1 on regression
+
+SCENARIOS = ("rename", "start", "broadcast", "workers", "probe", "offload", "queries", "download", "upload", "stream")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("scenario", choices=SCENARIOS + ("all",))
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--files", type=int, default=3, help="files per user (rename)")
+    parser.add_argument("--size", type=float, default=20, help="file size in MB (rename, workers, probe, download, upload, stream)")
+    parser.add_argument("--kinds", default="document,video", help="output types to cycle through (rename)")
+    parser.add_argument("--popular", type=float, default=0.0, help="fraction of renames of one shared file (rename)")
+    parser.add_argument("--starts", type=int, default=20, help="/start per user (start)")
+    parser.add_argument("--audience", type=int, default=500, help="users in the database (broadcast, queries)")
+    parser.add_argument("--blocked", type=float, default=0.05, help="fraction of them that blocked the bot (broadcast)")
+    parser.add_argument("--jobs", type=int, default=40, help="queued jobs (workers)")
+    parser.add_argument("--workers", default="1,2,4", help="worker process counts to compare (workers)")
+    parser.add_argument("--extractions", type=int, default=8, help="concurrent thumbnail and metadata jobs (offload)")
+    parser.add_argument("--parallelism", default="1,2,4,8", help="DOWNLOAD_PARALLELISM values to compare (download)")
+    parser.add_argument("--windows", default="1,4,8", help="UPLOAD_WINDOW values to compare (upload)")
+    parser.add_argument("--sessions", default="1,3", help="UPLOAD_SESSIONS values to compare (upload)")
+    parser.add_argument("--bandwidth", type=float, default=50, help="MB/s per connection")
+    parser.add_argument("--latency", type=float, default=20, help="ms per request")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="FloodWait probability of rate limited calls")
+    parser.add_argument("--flood-wait", type=int, default=1, help="FloodWait seconds")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a request counts as failed")
+    parser.add_argument("--mongo", help="mongod URL; default is mongomock-motor")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of a previous run to check against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    return parser.parse_args()
+
+
+def setup_env(args, tmp):
+    # Before anything imports config; explicit environment still wins
+    defaults = dict(
+        FLOOD="0",
+        TMP_DIR=os.path.join(tmp, "ren_tmp"),
+        THUMB_CACHE_DIR=os.path.join(tmp, "thumb_cache"),
+        MIN_FREE_SPACE="0",
+        DB_URL=args.mongo or "mongodb://localhost:27017",
+        DB_NAME="renamer_bench",
+        PROGRESS_INTERVAL="1",
+        JOB_POLL="0.05",
+        # The rename scenario runs jobs in-process; workers drives JobWorker directly
+        JOB_BACKEND="local",
+    )
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def use_mongomock(db):
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("mongomock-motor is not installed: pip install mongomock-motor, or pass --mongo URL")
+    db._client = AsyncMongoMockClient()
+    db.db = db._client[os.environ["DB_NAME"]]
+    db.col, db.bcast, db.thumbs, db.jobs = db.db.user, db.db.broadcasts, db.db.thumbs, db.db.jobs
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+    return {"p50_ms": at(50), "p95_ms": at(95), "p99_ms": at(99), "max_ms": round(values[-1] * 1000, 1)}
+
+
+def new_link(args):
+    return Link(args.bandwidth * CHUNK, args.latency / 1000, args.flood_rate, args.flood_wait)
+
+
+async def timed(latencies, coro):
+    start = time.perf_counter()
+    await coro
+    latencies.append(time.perf_counter() - start)
+
+
+async def rename_flow(client, args, user_id, kind, popular):
+    # What a user does in Telegram: send a file, tap rename, type the new
+    # name, pick the output type; done when the renamed file arrives
+    from plugins.start import rename_start
+    from plugins.cb_data import ask_new_name, do_upload
+    from plugins.filedetect import refunc
+
+    size = int(args.size * CHUNK)
+    if popular:
+        file = client.new_file(user_id, kind, size, name="Popular.Movie.2023.1080p.mkv", unique_id="popular")
+    else:
+        file = client.new_file(user_id, kind, size)
+    await rename_start(client, file)
+    prompt = client.replies[file.id]
+    await ask_new_name(client, FakeQuery(prompt, "rename", user_id))
+    await refunc(client, client.user_message(user_id, "Popular Movie" if popular else f"Renamed {file.id}", reply_to_message=prompt))
+    choice = client.replies[file.id]
+    await do_upload(client, FakeQuery(choice, f"upload_{kind}", user_id))
+    await client.delivered[file.id].wait()
+
+
+async def scenario_rename(args, client):
+    from helper.scheduler import scheduler
+    kinds = args.kinds.split(",")
+    latencies, failed = [], 0
+    scheduler.start()
+
+    async def user(user_id):
+        nonlocal failed
+        for i in range(args.files):
+            kind = kinds[(user_id + i) % len(kinds)]
+            popular = random.random() < args.popular
+            try:
+                await asyncio.wait_for(timed(latencies, rename_flow(client, args, user_id, kind, popular)), args.timeout)
+            except Exception as e:
+                failed += 1
+                logging.warning(f"rename of user {user_id} failed: {e!r}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(1000 + u) for u in range(args.users)))
+    seconds = time.perf_counter() - start
+    await scheduler.stop()
+    done = len(latencies)
+    return dict(
+        requests=done + failed,
+        failed=failed,
+        seconds=round(seconds, 2),
+        throughput=round(done / seconds, 3),
+        mb_per_s=round(done * args.size / seconds, 2),
+        uploads=client.sent_files,
+        **percentiles(latencies)
+    )
+
+
+async def scenario_start(args, client):
+    from plugins.start import start as start_handler
+    latencies = []
+
+    async def user(user_id):
+        for _ in range(args.starts):
+            await timed(latencies, start_handler(client, client.user_message(user_id, "/start")))
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(user(2000 + u) for u in range(args.users)))
+    seconds = time.perf_counter() - begin
+    return dict(
+        requests=len(latencies),
+        seconds=round(seconds, 2),
+        throughput=round(len(latencies) / seconds, 1),
+        **percentiles(latencies)
+    )
+
+
+async def scenario_broadcast(args, client):
+    from helper.database import db
+    from plugins.broadcast import broadcast_handler
+    ids = list(range(10 ** 6, 10 ** 6 + args.audience))
+    await db.col.delete_many({})
+    await db.col.insert_many([db.new_user(i) for i in ids])
+    client.blocked = set(random.sample(ids, int(len(ids) * args.blocked)))
+    admin = 1
+    message = client.user_message(admin, "/broadcast", reply_to_message=client.user_message(admin, "Hello everyone"))
+    start = time.perf_counter()
+    await (await broadcast_handler(client, message))
+    seconds = time.perf_counter() - start
+    left = await db.col.count_documents({})
+    return dict(
+        requests=args.audience,
+        seconds=round(seconds, 2),
+        throughput=round(args.audience / seconds, 1),
+        delivered=client.copies,
+        dead_users_removed=args.audience - left,
+        flood_waits=client.link.flood_waits
+    )
+
+
+async def scenario_workers(args, client):
+    # JOB_BACKEND=mongo scaling: the same queue drained by 1, 2, 4... worker
+    # processes, each simulated by its own FakeClient and link
+    from helper.database import db
+    from helper.jobqueue import JobWorker
+    from plugins.cb_data import enqueue_rename, run_queued
+    counts = [int(n) for n in args.workers.split(",")]
+    results = {}
+    for count in counts:
+        await db.jobs.delete_many({})
+        files = []
+        for n in range(args.jobs):
+            user_id = 3000 + n % args.users
+            src = client.new_file(user_id, "document", int(args.size * CHUNK))
+            prompt = client.user_message(user_id, "queued")
+            await enqueue_rename(user_id, prompt, src, "document", f"Renamed {src.id}.mkv")
+            files.append(src)
+        workers = [JobWorker(client.clone(new_link(args)), run_queued, worker_id=f"bench-{count}-{i}", concurrency=1) for i in range(count)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        await asyncio.wait_for(asyncio.gather(*(client.delivered[f.id].wait() for f in files)), args.timeout)
+        seconds = time.perf_counter() - start
+        for worker in workers:
+            await worker.stop()
+            client.link.requests += worker.client.link.requests
+        results[count] = round(args.jobs / seconds, 3)
+    base = results[counts[0]] / counts[0]
+    return dict(
+        requests=args.jobs * len(counts),
+        throughput=results[counts[-1]],
+        jobs_per_s={str(k): v for k, v in results.items()},
+        scaling={str(k): round(v / (base * k), 2) for k, v in results.items()}
+    )
+
+
+def read_bytes():
+    # Bytes this process read through read() calls so far (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            return int(next(line for line in f if line.startswith("rchar")).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+
+def measure(func, *args):
+    before = read_bytes()
+    start = time.perf_counter()
+    result = func(*args)
+    ms = round((time.perf_counter() - start) * 1000, 2)
+    after = read_bytes()
+    return result, ms, after - before if before is not None else None
+
+
+async def scenario_probe(args, client):
+    # Header-only probing against a full hachoir parse, over generated MP4
+    # (moov at the end), Matroska and MP3 files of --size MB
+    from benchmarks.samples import FORMATS
+    from helper.probe import probe_headers, probe_file
+    from helper.media import read_meta
+    from helper.metrics import metrics
+    formats = {}
+    probes, seconds = 0, 0.0
+    for name, make in FORMATS.items():
+        path = os.path.join(args.tmp, f"sample.{name}")
+        make(path, int(args.size * CHUNK))
+        headers, headers_ms, headers_bytes = measure(probe_headers, path)
+        full, full_ms, full_bytes = measure(read_meta, path)
+        formats[name] = dict(
+            headers_ms=headers_ms,
+            headers_bytes=headers_bytes,
+            headers_found=list(headers[:3]) if headers else None,
+            hachoir_ms=full_ms,
+            hachoir_bytes=full_bytes,
+            hachoir_found=list(full)
+        )
+        probes += 1
+        seconds += headers_ms / 1000
+        # A second rename of the same Telegram file is answered from the cache
+        for _ in range(2):
+            await probe_file(path, f"sample-{name}")
+        os.remove(path)
+    return dict(
+        requests=probes,
+        throughput=round(probes / seconds, 1) if seconds else None,
+        formats=formats,
+        cache_hits=metrics.get("probe_total", method="cache")
+    )
+
+
+async def loop_lag(samples, interval=0.01):
+    # Like helper.metrics.watch_loop_lag, at a finer interval
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(time.perf_counter() - start - interval, 0))
+
+
+async def scenario_offload(args, client):
+    # Event loop lag while --extractions thumbnail normalisations and hachoir
+    # parses run at once: called inline on the loop (how the handlers used
+    # to do it) and through helper.offload (MEDIA_POOL / MEDIA_WORKERS)
+    import shutil
+    from PIL import Image
+    from benchmarks.samples import mkv
+    from helper.media import normalize_thumb, read_meta
+    from helper.offload import run_blocking
+    photo = os.path.join(args.tmp, "photo.jpg")
+    Image.effect_noise((3000, 2000), 64).convert("RGB").save(photo, "JPEG", quality=95)
+    video = os.path.join(args.tmp, "sample.mkv")
+    mkv(video, int(args.size * CHUNK))
+
+    async def inline(func, *a):
+        return func(*a)
+
+    results = {}
+    for mode, call in (("inline", inline), ("pool", run_blocking)):
+        jobs = []
+        for i in range(args.extractions):
+            copy = os.path.join(args.tmp, f"thumb{i}.jpg")
+            shutil.copy(photo, copy)
+            jobs.append(call(normalize_thumb, copy))
+            jobs.append(call(read_meta, video))
+        samples = []
+        ticker = asyncio.create_task(loop_lag(samples))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await asyncio.gather(*jobs)
+        seconds = time.perf_counter() - start
+        # Let the ticker record the stall the last job caused
+        await asyncio.sleep(0.05)
+        ticker.cancel()
+        results[mode] = dict(seconds=round(seconds, 2), lag=percentiles(samples))
+    # No top-level p95: lag in the single-digit ms is too noisy for --compare
+    return dict(requests=args.extractions * 2, **results)
+
+
+async def scenario_queries(args, client):
+    # Bytes returned and latency of the user queries before the projection /
+    # estimated count change and after it (helper.database as it is now).
+    # Latency only means something against a real mongod (--mongo).
+    import bson
+    from helper.database import db, USER_FIELDS
+    ids = list(range(4 * 10 ** 6, 4 * 10 ** 6 + args.audience))
+    await db.col.delete_many({})
+    # Users carry more than the handlers read, e.g. thumbnail metadata and
+    # fields older versions of the bot stored
+    await db.col.insert_many([dict(
+        db.new_user(i),
+        file_id="AgACAgQAAxkBAAI" + "x" * 60,
+        caption="{filename} " + "c" * 200,
+        thumb=dict(width=320, height=180, size=18000),
+        history=["y" * 40] * 20
+    ) for i in ids])
+    sample = random.sample(ids, min(200, len(ids)))
+
+    async def lookups(projection):
+        size, start = 0, time.perf_counter()
+        for i in sample:
+            size += len(bson.encode(await db.col.find_one({'_id': i}, projection)))
+        return size, (time.perf_counter() - start) / len(sample)
+
+    async def scan(cursor):
+        size, start = 0, time.perf_counter()
+        async for user in cursor:
+            size += len(bson.encode(user))
+        return size, time.perf_counter() - start
+
+    async def count(coro):
+        start = time.perf_counter()
+        await coro
+        return 0, time.perf_counter() - start
+
+    before = dict(
+        get_user=await lookups(None),
+        all_users=await scan(db.col.find({})),
+        users_count=await count(db.col.count_documents({}))
+    )
+    after = dict(
+        get_user=await lookups(USER_FIELDS),
+        all_users=await scan(await db.get_all_users()),
+        users_count=await count(db.col.estimated_document_count())
+    )
+
+    def report(ops):
+        return {op: dict(bytes=size, ms=round(seconds * 1000, 3)) for op, (size, seconds) in ops.items()}
+    return dict(requests=len(sample) * 2 + 4, before=report(before), after=report(after))
+
+
+async def scenario_download(args, client):
+    # parallel_download with DOWNLOAD_PARALLELISM 1 against higher values.
+    # Every fake stream_media call is one connection of --bandwidth, like a
+    # media session to Telegram.
+    from helper.transfer import parallel_download
+    levels = [int(n) for n in args.parallelism.split(",")]
+    size = int(args.size * CHUNK)
+    src = client.new_file(5000, "document", size)
+    path = os.path.join(args.tmp, "download.bin")
+    results, calls = {}, {}
+    for level in levels:
+        streams = client.streams
+        start = time.perf_counter()
+        await parallel_download(client, src, path, size, parallelism=level)
+        seconds = time.perf_counter() - start
+        os.remove(path)
+        results[level] = round(args.size / seconds, 2)
+        calls[level] = client.streams - streams
+    base = results[levels[0]]
+    return dict(
+        requests=len(levels),
+        throughput=results[levels[-1]],
+        mb_per_s={str(k): v for k, v in results.items()},
+        speedup={str(k): round(v / base, 2) for k, v in results.items()},
+        stream_media_calls={str(k): v for k, v in calls.items()}
+    )
+
+
+async def scenario_upload(args, client):
+    # upload_file through FakeSession for every UPLOAD_WINDOW x UPLOAD_SESSIONS
+    # pair; sessions only apply to files over 10 MB, like on Telegram
+    from helper import transfer
+    windows = [int(n) for n in args.windows.split(",")]
+    sessions = [int(n) for n in args.sessions.split(",")]
+    path = os.path.join(args.tmp, "upload.bin")
+    with open(path, "wb") as f:
+        f.truncate(int(args.size * CHUNK))
+    saved = transfer.UPLOAD_WINDOW, transfer.UPLOAD_SESSIONS
+    results = {}
+    try:
+        for window in windows:
+            for count in sessions:
+                transfer.UPLOAD_WINDOW, transfer.UPLOAD_SESSIONS = window, count
+                start = time.perf_counter()
+                await transfer.upload_file(client, path, "upload.bin")
+                results[f"{window}x{count}"] = round(args.size / (time.perf_counter() - start), 2)
+    finally:
+        transfer.UPLOAD_WINDOW, transfer.UPLOAD_SESSIONS = saved
+        os.remove(path)
+    return dict(
+        requests=len(results),
+        throughput=results[f"{windows[-1]}x{sessions[-1]}"],
+        # keyed "window x sessions"
+        mb_per_s=results
+    )
+
+
+async def scenario_stream(args, client):
+    # One file renamed without the handlers: piped through stream_upload
+    # (STREAM_UPLOADS) against staged on disk, i.e. downloaded the way
+    # _run_pipeline does it and then sent with upload_file
+    from config import DOWNLOAD_PARALLELISM, PARALLEL_MIN_SIZE
+    from helper.transfer import stream_upload, parallel_download, upload_file
+    size = int(args.size * CHUNK)
+    src = client.new_file(5001, "document", size)
+    path = os.path.join(args.tmp, "staged.bin")
+
+    async def staged():
+        if DOWNLOAD_PARALLELISM > 1 and size >= PARALLEL_MIN_SIZE:
+            await parallel_download(client, src, path, size)
+        else:
+            await client.download_media(src, file_name=path)
+        await upload_file(client, path, "renamed.bin")
+        os.remove(path)
+        return args.size
+
+    async def streamed():
+        await stream_upload(client, src, "renamed.bin", size)
+        return 0
+
+    results = {}
+    for mode, transfer in (("staged", staged), ("streamed", streamed)):
+        start = time.perf_counter()
+        disk = await transfer()
+        seconds = time.perf_counter() - start
+        results[mode] = dict(seconds=round(seconds, 2), mb_per_s=round(args.size / seconds, 2), disk_mb=disk)
+    return dict(requests=2, throughput=results["streamed"]["mb_per_s"], **results)
+
+
+def memory(heap_peak):
+    # ru_maxrss is KB on Linux
+    result = {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if heap_peak is not None:
+        result["heap_peak_mb"] = round(heap_peak / CHUNK, 1)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before.get("throughput") and now.get("throughput", 0) < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {now.get('throughput')} < {before['throughput']}")
+        if before.get("p95_ms") and now.get("p95_ms", 0) > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {now.get('p95_ms')}ms > {before['p95_ms']}ms")
+    return regressions
+
+
+async def run(args):
+    from helper import transfer
+    from helper.database import db
+    from helper.metrics import metrics
+    from benchmarks import fake
+    import plugins.cb_data
+
+    # The two calls that need a real MTProto connection
+    transfer._media_session = fake.media_session
+    plugins.cb_data.send_uploaded = fake.send_uploaded
+    if not args.mongo:
+        use_mongomock(db)
+    await db._client.drop_database(os.environ["DB_NAME"])
+    await db.ensure_indexes()
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {}
+    for name in scenarios:
+        client = FakeClient(new_link(args))
+        if args.tracemalloc:
+            tracemalloc.start()
+        result = await globals()[f"scenario_{name}"](args, client)
+        heap_peak = None
+        if args.tracemalloc:
+            heap_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result.update(memory(heap_peak))
+        result["telegram_requests"] = client.link.requests
+        results[name] = result
+        print(f"{name}: {json.dumps(result)}")
+    results["_metrics"] = {
+        "flood_waits": metrics.total("flood_waits_total"),
+        "progress_edits_sent": metrics.get("progress_updates_total", result="sent"),
+        "progress_edits_suppressed": metrics.total("progress_updates_total") - metrics.get("progress_updates_total", result="sent"),
+        "renames_deduplicated": metrics.get("rename_jobs_total", path="dedup"),
+        "user_cache_hits": metrics.get("user_cache_total", result="hit"),
+    }
+    return results
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix="renamer-bench-") as tmp:
+        setup_env(args, tmp)
+        args.tmp = tmp
+        results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
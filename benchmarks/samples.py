@@ -0,0 +1,63 @@
+import struct
+
+# Minimal but well-formed media files for the probe benchmark. The payload
+# (mdat, Matroska clusters, MP3 frames) is padding of the requested size, so
+# header-only probing and a full parse read very different amounts.
+
+WIDTH, HEIGHT, DURATION = 1280, 720, 1440
+
+
+def _box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def mp4(path, size):
+    # ftyp, a big mdat, then moov at the end like most phone recordings
+    mvhd = struct.pack(">I8xII", 0, 1000, DURATION * 1000).ljust(100, b"\0")
+    tkhd = bytes(76) + struct.pack(">II", WIDTH << 16, HEIGHT << 16)
+    moov = _box(b"moov", _box(b"mvhd", mvhd) + _box(b"trak", _box(b"tkhd", tkhd)))
+    with open(path, "wb") as f:
+        f.write(_box(b"ftyp", b"isom\0\0\2\0isomiso2mp41"))
+        f.write(struct.pack(">I4s", 8 + size, b"mdat"))
+        f.truncate(f.tell() + size)
+        f.seek(0, 2)
+        f.write(moov)
+
+
+def _element(eid, payload):
+    # EBML element with an 8 byte size field
+    return eid.to_bytes((eid.bit_length() + 7) // 8, "big") + (0x01 << 56 | len(payload)).to_bytes(8, "big") + payload
+
+
+def mkv(path, size):
+    header = _element(0x1A45DFA3, _element(0x4282, b"matroska"))
+    info = _element(0x1549A966, _element(0x2AD7B1, (1000000).to_bytes(3, "big")) + _element(0x4489, struct.pack(">d", DURATION * 1000.0)))
+    video = _element(0xE0, _element(0xB0, WIDTH.to_bytes(2, "big")) + _element(0xBA, HEIGHT.to_bytes(2, "big")))
+    track = _element(0xAE, _element(0xD7, b"\1") + _element(0x83, b"\1") + _element(0x86, b"V_MPEG4/ISO/AVC") + video)
+    tracks = _element(0x1654AE6B, track)
+    with open(path, "wb") as f:
+        f.write(header)
+        # Segment of unknown size, as written by live muxers
+        f.write(bytes.fromhex("18538067") + bytes.fromhex("01ffffffffffffff"))
+        f.write(info + tracks)
+        cluster = 1024 * 1024
+        for _ in range(max(1, size // cluster)):
+            f.write(_element(0x1F43B675, _element(0xE7, b"\0") + _element(0xA3, bytes(cluster))))
+
+
+def mp3(path, size):
+    # MPEG-1 layer III, 128 kbps, 44.1 kHz; the first frame carries a Xing
+    # header with the frame count
+    frame_len = 144 * 128000 // 44100
+    frames = max(1, size // frame_len)
+    header = bytes.fromhex("fffb9064")
+    first = header + bytes(32) + b"Xing" + struct.pack(">II", 1, frames)
+    with open(path, "wb") as f:
+        f.write(b"ID3\3\0\0\0\0\0\0")
+        f.write(first.ljust(frame_len, b"\0"))
+        frame = header.ljust(frame_len, b"\0")
+        for _ in range(frames - 1):
+            f.write(frame)
+
+
+FORMATS = {"mp4": mp4, "mkv": mkv, "mp3": mp3}
@@ -1,9 +1,16 @@
 import logging
 import logging.config
 from pyrogram import Client 
-from config import API_ID, API_HASH, BOT_TOKEN, FORCE_SUB, PORT
+import asyncio
+from config import API_ID, API_HASH, BOT_TOKEN, FORCE_SUB, PORT, MAX_TRANSMISSIONS, LOOP_LAG_INTERVAL, LOOP_LAG_WARN
 from aiohttp import web
 from plugins.web_support import web_server
+from helper.scheduler import scheduler
+from helper.workspace import workspaces
+from helper.broadcast import resume_jobs, stop_jobs
+from helper.database import db
+from helper.metrics import watch_loop_lag
+from helper import offload
 
 logging.config.fileConfig('logging.conf')
 logging.getLogger().setLevel(logging.INFO)
@@ -21,6 +28,7 @@ class Bot(Client):
             workers=50,
             plugins={"root": "plugins"},
             sleep_threshold=5,
+            max_concurrent_transmissions=MAX_TRANSMISSIONS,
         )
 
     async def start(self):
@@ -37,14 +45,23 @@ class Bot(Client):
             logging.warning(e)
             logging.warning("Make Sure Bot admin in force sub channel")             
             self.force_channel = None
-       app = web.AppRunner(await web_server())
+       self.lag_watchdog = asyncio.create_task(watch_loop_lag(LOOP_LAG_INTERVAL, LOOP_LAG_WARN))
+       app = web.AppRunner(await web_server(self))
        await app.setup()
        bind_address = "0.0.0.0"
        await web.TCPSite(app, bind_address, PORT).start()
+       await db.ensure_indexes()
+       workspaces.cleanup_orphans()
+       scheduler.start()
+       await resume_jobs(self)
        logging.info(f"{me.first_name} ✅✅ BOT started successfully ✅✅")
       
 
     async def stop(self, *args):
+      self.lag_watchdog.cancel()
+      await stop_jobs()
+      await scheduler.stop()
+      offload.shutdown()
       await super().stop()      
       logging.info("Bot Stopped 🙄")
         
@@ -21,3 +21,97 @@ START_PIC = os.environ.get("START_PIC", "")
 ADMIN = [int(admin) if id_pattern.search(admin) else admin for admin in os.environ.get('ADMIN', '').split()]
 
 PORT = os.environ.get("PORT", "8080")
+
+RENAME_WORKERS = int(os.environ.get("RENAME_WORKERS", "4"))
+
+USER_CONCURRENCY = int(os.environ.get("USER_CONCURRENCY", "1"))
+
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "200"))
+
+USER_QUEUE = int(os.environ.get("USER_QUEUE", "20"))
+
+TMP_DIR = os.environ.get("TMP_DIR", "ren_tmp")
+
+MIN_FREE_SPACE = int(os.environ.get("MIN_FREE_SPACE", "500")) * 1024 * 1024
+
+STREAM_UPLOADS = os.environ.get("STREAM_UPLOADS", "True").lower() in ("1", "true", "yes")
+
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER", "8"))
+
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "5"))
+
+PROGRESS_EDITS_PER_SEC = float(os.environ.get("PROGRESS_EDITS_PER_SEC", "8"))
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "300"))
+
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+
+BROADCAST_RETRIES = int(os.environ.get("BROADCAST_RETRIES", "5"))
+
+BROADCAST_CHECKPOINT = int(os.environ.get("BROADCAST_CHECKPOINT", "5"))
+
+BULK_SIZE = int(os.environ.get("BULK_SIZE", "500"))
+
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "1000"))
+
+MEDIA_POOL = os.environ.get("MEDIA_POOL", "thread")
+
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "2"))
+
+MEDIA_TIMEOUT = float(os.environ.get("MEDIA_TIMEOUT", "60"))
+
+THUMB_CACHE_DIR = os.environ.get("THUMB_CACHE_DIR", "thumb_cache")
+
+THUMB_CACHE_SIZE = int(os.environ.get("THUMB_CACHE_SIZE", "100")) * 1024 * 1024
+
+DOWNLOAD_PARALLELISM = int(os.environ.get("DOWNLOAD_PARALLELISM", "4"))
+
+PARALLEL_MIN_SIZE = int(os.environ.get("PARALLEL_MIN_SIZE", "20")) * 1024 * 1024
+
+MAX_TRANSMISSIONS = int(os.environ.get("MAX_TRANSMISSIONS", str(RENAME_WORKERS * DOWNLOAD_PARALLELISM)))
+
+UPLOAD_SESSIONS = int(os.environ.get("UPLOAD_SESSIONS", "3"))
+
+UPLOAD_WINDOW = int(os.environ.get("UPLOAD_WINDOW", "8"))
+
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "5"))
+
+DEDUP_TTL = int(os.environ.get("DEDUP_TTL", "1800"))
+
+DEDUP_SIZE = int(os.environ.get("DEDUP_SIZE", "2000"))
+
+JOB_BACKEND = os.environ.get("JOB_BACKEND", "local").lower()
+
+WORKER_ID = os.environ.get("WORKER_ID", f"{os.uname().nodename}-{os.getpid()}")
+
+WORKER_PORT = int(os.environ.get("WORKER_PORT", "8081"))
+
+JOB_LEASE = int(os.environ.get("JOB_LEASE", "60"))
+
+JOB_HEARTBEAT = int(os.environ.get("JOB_HEARTBEAT", "10"))
+
+JOB_POLL = float(os.environ.get("JOB_POLL", "2"))
+
+JOB_ATTEMPTS = int(os.environ.get("JOB_ATTEMPTS", "3"))
+
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "1"))
+
+LOOP_LAG_WARN = float(os.environ.get("LOOP_LAG_WARN", "0.5"))
+
+HEALTH_MAX_LAG = float(os.environ.get("HEALTH_MAX_LAG", "5"))
+
+TRACE_KEEP = int(os.environ.get("TRACE_KEEP", "200"))
+
+PROFILE_RATE = float(os.environ.get("PROFILE_RATE", "0"))
+
+PROFILE_INTERVAL = int(os.environ.get("PROFILE_INTERVAL", "10"))
+
+FSUB_CACHE_TTL = int(os.environ.get("FSUB_CACHE_TTL", "300"))
+
+FSUB_NEGATIVE_TTL = int(os.environ.get("FSUB_NEGATIVE_TTL", "10"))
+
+FSUB_CACHE_SIZE = int(os.environ.get("FSUB_CACHE_SIZE", "10000"))
@@ -0,0 +1,182 @@
+import time
+import asyncio
+import logging
+import datetime
+from collections import deque
+from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, PeerIdInvalid
+from config import BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_RETRIES, BROADCAST_CHECKPOINT
+from helper.database import db
+from helper.metrics import metrics, JOB_BUCKETS
+from helper.ratelimit import AdaptiveTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Broadcast tasks of this process, cancelled by stop_jobs() on shutdown
+_tasks = set()
+
+
+class Broadcast:
+    # Copies one message to many users with a fixed window of concurrent
+    # sends, all drawing from one rate limiter that adapts to FloodWait.
+
+    def __init__(self, message, concurrency=BROADCAST_CONCURRENCY, rate=BROADCAST_RATE):
+        self.message = message
+        self.concurrency = concurrency
+        self.limiter = AdaptiveTokenBucket(rate)
+        self.done = 0
+        self.success = 0
+        self.failed = 0
+        self.dead = 0
+        # Highest user id such that every id up to it has been handled
+        self.cursor = None
+        self._dispatched = deque()
+        self._finished = set()
+
+    async def send(self, user_id):
+        for _ in range(BROADCAST_RETRIES):
+            await self.limiter.acquire()
+            try:
+                await self.message.copy(chat_id=int(user_id))
+            except FloodWait as e:
+                metrics.inc("flood_waits_total", source="broadcast")
+                self.limiter.on_flood(e.value)
+                continue
+            except InputUserDeactivated:
+                logger.info(f"{user_id} : deactivated")
+                return 400
+            except UserIsBlocked:
+                logger.info(f"{user_id} : blocked the bot")
+                return 400
+            except PeerIdInvalid:
+                logger.info(f"{user_id} : user id invalid")
+                return 400
+            except Exception as e:
+                logger.error(f"{user_id} : {e}")
+                return 500
+            self.limiter.on_success()
+            return 200
+        logger.error(f"{user_id} : gave up after {BROADCAST_RETRIES} FloodWaits")
+        return 500
+
+    async def _worker(self, queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            sts = await self.send(user_id)
+            if sts == 200:
+                self.success += 1
+            else:
+                self.failed += 1
+            if sts == 400:
+                self.dead += 1
+                await db.queue_delete(user_id)
+            self.done += 1
+            metrics.inc("broadcast_messages_total", status=str(sts))
+            self._finished.add(user_id)
+            while self._dispatched and self._dispatched[0] in self._finished:
+                self.cursor = self._dispatched.popleft()
+                self._finished.discard(self.cursor)
+
+    async def run(self, user_ids):
+        # user_ids is any async iterable of ids in ascending order
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            async for user_id in user_ids:
+                self._dispatched.append(user_id)
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            # Let in-flight sends settle, so `cursor` is final when we return
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def _status_text(job, bc, final=False):
+    total = job['total']
+    if final:
+        completed_in = datetime.timedelta(seconds=int(time.time() - job['started']))
+        return f"Broadcast Completed:\nCompleted in `{completed_in}`.\n\nTotal Users {total}\nCompleted: {bc.done} / {total}\nSuccess: {bc.success}\nFailed: {bc.failed}"
+    return f"Broadcast in progress:\nTotal Users {total}\nCompleted: {bc.done} / {total}\nSuccess: {bc.success}\nFailed: {bc.failed}"
+
+
+async def run_job(client, job):
+    # Runs (or resumes) a broadcast job document. Progress is written back
+    # every BROADCAST_CHECKPOINT seconds, so after a restart only users that
+    # were in flight at that moment can receive the message twice.
+    message = await client.get_messages(job['from_chat_id'], job['message_id'])
+    if not message or message.empty:
+        await db.update_broadcast(job['_id'], status="failed")
+        return
+    bc = Broadcast(message)
+    bc.done = job.get('done', 0)
+    bc.success = job.get('success', 0)
+    bc.failed = job.get('failed', 0)
+    bc.cursor = job.get('cursor')
+
+    async def checkpoint(final=False):
+        await db.flush_deletes()
+        await db.update_broadcast(
+            job['_id'],
+            cursor=bc.cursor,
+            done=bc.done,
+            success=bc.success,
+            failed=bc.failed,
+            status="done" if final else "running"
+        )
+        try:
+            await client.edit_message_text(job['status_chat_id'], job['status_message_id'], _status_text(job, bc, final))
+        except Exception:
+            pass
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT)
+            try:
+                await checkpoint()
+            except Exception as e:
+                logger.warning(f"broadcast checkpoint failed: {e}")
+
+    reporter = asyncio.create_task(report())
+    metrics.add("broadcasts_running", 1)
+    try:
+        with metrics.timer("broadcast_run_seconds", JOB_BUCKETS):
+            await bc.run(db.iter_user_ids(after=bc.cursor))
+    except asyncio.CancelledError:
+        # Shutting down: save the cursor so the resumed job only repeats the
+        # sends that were in flight
+        reporter.cancel()
+        try:
+            await checkpoint()
+        except Exception as e:
+            logger.warning(f"broadcast checkpoint failed: {e}")
+        raise
+    finally:
+        metrics.add("broadcasts_running", -1)
+        reporter.cancel()
+    await checkpoint(final=True)
+
+
+def start_job(client, job):
+    task = asyncio.create_task(run_job(client, job))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def stop_jobs():
+    # Graceful shutdown: each running broadcast writes a last checkpoint
+    tasks = list(_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def resume_jobs(client):
+    for job in await db.get_running_broadcasts():
+        logger.info(f"resuming broadcast {job['_id']} after user {job.get('cursor')}")
+        start_job(client, job)
@@ -1,5 +1,76 @@
+import time
+import datetime
+import functools
+from contextlib import contextmanager
 import motor.motor_asyncio
-from config import DB_URL, DB_NAME
+from collections import OrderedDict
+from pymongo import DeleteOne, ReturnDocument
+from config import DB_URL, DB_NAME, USER_CACHE_SIZE, USER_CACHE_TTL, BULK_SIZE, DB_BATCH_SIZE, JOB_ATTEMPTS
+from helper.metrics import metrics
+
+# Fields handlers actually read; anything else stored on the user is skipped
+USER_FIELDS = {'file_id': 1, 'thumb': 1, 'caption': 1}
+
+
+def timed(func):
+    # Mongo latency and errors per Database method, for /metrics
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            with metrics.timer("mongo_op_seconds", op=func.__name__):
+                return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("mongo_errors_total", op=func.__name__)
+            raise
+    return wrapper
+
+
+class UserCache:
+    # TTL + LRU cache of whole user documents. A missing user is cached as
+    # None too, so /start for known and unknown users both skip Mongo.
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # id -> [reads in flight, invalidations since the first one started].
+        # Only ids being read are tracked, so this stays small.
+        self._reads = {}
+
+    def get(self, id):
+        entry = self._data.get(id)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        self._data.move_to_end(id)
+        return True, entry[1]
+
+    @contextmanager
+    def reading(self, id):
+        # Wrap a database read; yields the epoch to pass to put()
+        entry = self._reads.setdefault(id, [0, 0])
+        entry[0] += 1
+        try:
+            yield entry[1]
+        finally:
+            entry[0] -= 1
+            if not entry[0]:
+                del self._reads[id]
+
+    def put(self, id, user, epoch=None):
+        # A read that raced with a write must not put the old document back
+        if epoch is not None and epoch != self._reads.get(id, (0, 0))[1]:
+            return
+        self._data[id] = (time.monotonic() + self.ttl, user)
+        self._data.move_to_end(id)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, id):
+        self._data.pop(id, None)
+        entry = self._reads.get(id)
+        if entry is not None:
+            entry[1] += 1
+
 
 class Database:
 
@@ -7,46 +78,299 @@ class Database:
         self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
         self.db = self._client[database_name]
         self.col = self.db.user
+        self.bcast = self.db.broadcasts
+        self.thumbs = self.db.thumbs
+        self.jobs = self.db.jobs
+        self.cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self._deletes = []
+
+    @timed
+    async def ping(self):
+        await self._client.admin.command('ping')
+
+    async def ensure_indexes(self):
+        # Run once on startup; safe to repeat
+        await self.bcast.create_index('status')
+        await self.jobs.create_index([('status', 1), ('created_at', 1)])
+        await self.jobs.create_index('key')
+        await self.jobs.create_index([('user_id', 1), ('status', 1)])
 
     def new_user(self, id):
         return dict(
-            _id=int(id),                                   
+            _id=int(id),
             file_id=None,
             caption=None
         )
 
+    async def get_user(self, id):
+        id = int(id)
+        found, user = self.cache.get(id)
+        if found:
+            metrics.inc("user_cache_total", result="hit")
+            return user
+        metrics.inc("user_cache_total", result="miss")
+        with self.cache.reading(id) as epoch:
+            with metrics.timer("mongo_op_seconds", op="get_user"):
+                user = await self.col.find_one({'_id': id}, USER_FIELDS)
+            self.cache.put(id, user, epoch)
+        return user
+
     async def add_user(self, id):
+        # Single round-trip registration that also caches the user, new or
+        # not; returns True for a new user
         user = self.new_user(id)
-        await self.col.insert_one(user)
+        found, cached = self.cache.get(user['_id'])
+        if found and cached:
+            return False
+        with self.cache.reading(user['_id']) as epoch:
+            with metrics.timer("mongo_op_seconds", op="add_user"):
+                existing = await self.col.find_one_and_update(
+                    {'_id': user['_id']},
+                    {'$setOnInsert': user},
+                    projection=USER_FIELDS,
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE
+                )
+            self.cache.put(user['_id'], existing or user, epoch)
+        return existing is None
 
     async def is_user_exist(self, id):
-        user = await self.col.find_one({'_id': int(id)})
+        user = await self.get_user(id)
         return bool(user)
 
+    @timed
     async def total_users_count(self):
-        count = await self.col.count_documents({})
+        # Reads collection metadata instead of scanning every document
+        count = await self.col.estimated_document_count()
         return count
 
     async def get_all_users(self):
-        all_users = self.col.find({})
+        all_users = self.col.find({}, {'_id': 1}).batch_size(DB_BATCH_SIZE)
         return all_users
 
+    @timed
     async def delete_user(self, user_id):
         await self.col.delete_many({'_id': int(user_id)})
-    
-    async def set_thumbnail(self, id, file_id):
-        await self.col.update_one({'_id': int(id)}, {'$set': {'file_id': file_id}})
+        self.cache.invalidate(int(user_id))
+
+    async def queue_delete(self, user_id):
+        # Buffered delete, written with one bulk_write per BULK_SIZE users
+        self._deletes.append(int(user_id))
+        if len(self._deletes) >= BULK_SIZE:
+            await self.flush_deletes()
+
+    @timed
+    async def flush_deletes(self):
+        user_ids, self._deletes = self._deletes, []
+        if not user_ids:
+            return 0
+        result = await self.col.bulk_write([DeleteOne({'_id': i}) for i in user_ids], ordered=False)
+        for i in user_ids:
+            self.cache.invalidate(i)
+        return result.deleted_count
+
+    @timed
+    async def set_thumbnail(self, id, file_id, meta=None):
+        # meta holds width/height/size of the normalised copy in self.thumbs
+        await self.col.update_one({'_id': int(id)}, {'$set': {'file_id': file_id, 'thumb': meta}})
+        self.cache.invalidate(int(id))
 
     async def get_thumbnail(self, id):
-        user = await self.col.find_one({'_id': int(id)})
-        return user.get('file_id', None)
+        user = await self.get_user(id)
+        return user.get('file_id', None) if user else None
+
+    @timed
+    async def save_thumb(self, file_id, data):
+        await self.thumbs.update_one({'_id': file_id}, {'$set': {'data': data}}, upsert=True)
+
+    @timed
+    async def get_thumb(self, file_id):
+        thumb = await self.thumbs.find_one({'_id': file_id})
+        return thumb['data'] if thumb else None
 
+    @timed
+    async def delete_thumb(self, file_id):
+        await self.thumbs.delete_one({'_id': file_id})
+
+    @timed
     async def set_caption(self, id, caption):
         await self.col.update_one({'_id': int(id)}, {'$set': {'caption': caption}})
+        self.cache.invalidate(int(id))
 
     async def get_caption(self, id):
-        user = await self.col.find_one({'_id': int(id)})
-        return user.get('caption', None)
+        user = await self.get_user(id)
+        return user.get('caption', None) if user else None
+
+
+    async def iter_user_ids(self, after=None):
+        query = {'_id': {'$gt': after}} if after is not None else {}
+        async for user in self.col.find(query, {'_id': 1}).sort('_id', 1).batch_size(DB_BATCH_SIZE):
+            yield user['_id']
+
+    @timed
+    async def create_broadcast(self, **fields):
+        job = dict(
+            status="running",
+            cursor=None,
+            done=0,
+            success=0,
+            failed=0,
+            started=time.time(),
+            created_at=datetime.datetime.utcnow(),
+            **fields
+        )
+        job['_id'] = (await self.bcast.insert_one(job)).inserted_id
+        return job
+
+    @timed
+    async def update_broadcast(self, job_id, **fields):
+        await self.bcast.update_one({'_id': job_id}, {'$set': fields})
+
+    @timed
+    async def get_running_broadcasts(self):
+        return await self.bcast.find({'status': "running"}).to_list(None)
+
+    # Rename job queue shared by the bot and worker.py processes. A job is
+    # "queued" until a worker claims it, then "running" under a lease the
+    # worker keeps renewing; a lease that runs out makes it claimable again.
+
+    @timed
+    async def enqueue_job(self, **fields):
+        job = dict(
+            status="queued",
+            owner=None,
+            lease_until=None,
+            attempts=0,
+            cancel=False,
+            file_id=None,
+            created_at=datetime.datetime.utcnow(),
+            **fields
+        )
+        job['_id'] = (await self.jobs.insert_one(job)).inserted_id
+        return job
+
+    @timed
+    async def claim_job(self, worker_id, lease):
+        now = datetime.datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {
+                '$or': [
+                    {'status': "queued"},
+                    {'status': "running", 'lease_until': {'$lt': now}}
+                ],
+                'attempts': {'$lt': JOB_ATTEMPTS},
+                # A cancelled job whose worker died is not started again
+                'cancel': False
+            },
+            {
+                '$set': {
+                    'status': "running",
+                    'owner': worker_id,
+                    'lease_until': now + datetime.timedelta(seconds=lease)
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @timed
+    async def heartbeat_job(self, job_id, worker_id, lease):
+        # None once the lease is lost, else the job (with its cancel flag)
+        return await self.jobs.find_one_and_update(
+            {'_id': job_id, 'owner': worker_id, 'status': "running"},
+            {'$set': {'lease_until': datetime.datetime.utcnow() + datetime.timedelta(seconds=lease)}},
+            {'cancel': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    @timed
+    async def finish_job(self, job_id, worker_id, status, file_id=None, trace=None):
+        await self.jobs.update_one(
+            {'_id': job_id, 'owner': worker_id},
+            {'$set': {
+                'status': status,
+                'lease_until': None,
+                'file_id': file_id,
+                'trace': trace,
+                'finished_at': datetime.datetime.utcnow()
+            }}
+        )
+
+    @timed
+    async def fail_stale_jobs(self):
+        # Expired jobs that are not claimable any more: cancelled ones, and
+        # those whose workers died on every attempt. Returns (failed, cancelled).
+        now = datetime.datetime.utcnow()
+        cancelled = await self.jobs.update_many(
+            {'status': "running", 'lease_until': {'$lt': now}, 'cancel': True},
+            {'$set': {'status': "cancelled", 'lease_until': None}}
+        )
+        failed = await self.jobs.update_many(
+            {'status': "running", 'lease_until': {'$lt': now}, 'attempts': {'$gte': JOB_ATTEMPTS}},
+            {'$set': {'status': "failed", 'lease_until': None}}
+        )
+        return failed.modified_count, cancelled.modified_count
+
+    @timed
+    async def release_job(self, job_id, worker_id):
+        # Hand a job back on shutdown without spending one of its attempts
+        await self.jobs.update_one(
+            {'_id': job_id, 'owner': worker_id, 'status': "running"},
+            {'$set': {'status': "queued", 'owner': None, 'lease_until': None}, '$inc': {'attempts': -1}}
+        )
+
+    @timed
+    async def cancel_job(self, job_id, user_id):
+        # Queued jobs are cancelled here; running ones are flagged for their
+        # worker, which stops at the next heartbeat
+        job = await self.jobs.find_one_and_update(
+            {'_id': job_id, 'user_id': int(user_id), 'status': "queued"},
+            {'$set': {'status': "cancelled", 'cancel': True}}
+        )
+        if job:
+            return job
+        return await self.jobs.find_one_and_update(
+            {'_id': job_id, 'user_id': int(user_id), 'status': "running"},
+            {'$set': {'cancel': True}}
+        )
+
+    @timed
+    async def get_job(self, job_id):
+        return await self.jobs.find_one({'_id': job_id}, {'status': 1})
+
+    @timed
+    async def count_jobs(self, status, user_id=None):
+        query = {'status': status}
+        if user_id is not None:
+            query['user_id'] = int(user_id)
+        return await self.jobs.count_documents(query)
+
+    @timed
+    async def job_position(self, job):
+        return await self.jobs.count_documents({'status': "queued", 'created_at': {'$lt': job['created_at']}})
+
+    @timed
+    async def slow_jobs(self, limit, since):
+        # Traces of the slowest jobs finished by workers after `since`
+        jobs = self.jobs.find(
+            {'finished_at': {'$gt': since}, 'trace.total': {'$ne': None}},
+            {'trace': 1}
+        ).sort('trace.total', -1).limit(limit)
+        return [job['trace'] async for job in jobs]
+
+    @timed
+    async def recent_job_result(self, key, ttl):
+        job = await self.jobs.find_one(
+            {
+                'key': key,
+                'status': "done",
+                'finished_at': {'$gt': datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)}
+            },
+            {'file_id': 1},
+            sort=[('finished_at', -1)]
+        )
+        return job['file_id'] if job else None
 
 
 db = Database(DB_URL, DB_NAME)
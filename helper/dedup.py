@@ -0,0 +1,69 @@
+import time
+import asyncio
+from collections import OrderedDict
+from config import DEDUP_TTL, DEDUP_SIZE
+
+
+class JobIndex:
+    # Renames keyed by source file + output settings. A request identical to
+    # one still running waits for its result instead of downloading again,
+    # and one identical to a recently finished rename gets the produced
+    # file_id, which can be re-sent without any transfer.
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._inflight = {}
+        self._done = OrderedDict()
+
+    @staticmethod
+    def key(media, kind, new_name, thumb_id):
+        # The file_id re-send keeps name, type and thumbnail, so all of them
+        # are part of the key
+        return media.file_unique_id, kind, new_name, thumb_id
+
+    def recent(self, key):
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        file_id, expires = entry
+        if expires < time.monotonic():
+            del self._done[key]
+            return None
+        self._done.move_to_end(key)
+        return file_id
+
+    def inflight(self, key):
+        return self._inflight.get(key)
+
+    def begin(self, key):
+        # Future with the produced file_id, or None if the job did not finish
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    def finish(self, key, file_id=None):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(file_id)
+        if file_id:
+            self._done[key] = (file_id, time.monotonic() + self.ttl)
+            self._done.move_to_end(key)
+            while len(self._done) > self.size:
+                self._done.popitem(last=False)
+
+    def release(self, key, future):
+        # Called when the job behind `future` is over. Normally rename_job has
+        # already finished it; a job cancelled before it started has not, and
+        # its waiters would hang. A newer job under the same key is left alone.
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.done():
+            future.set_result(None)
+
+    def forget(self, key):
+        # The produced file is gone or unusable
+        self._done.pop(key, None)
+
+
+jobs_index = JobIndex(DEDUP_TTL, DEDUP_SIZE)
@@ -0,0 +1,150 @@
+import time
+import asyncio
+import datetime
+import logging
+from config import WORKER_ID, JOB_LEASE, JOB_HEARTBEAT, JOB_POLL, RENAME_WORKERS
+from helper.database import db
+from helper.scheduler import Job
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedJob(Job):
+    # A scheduler Job for a document of db.jobs, so cancellation tokens and
+    # progress buttons work the same as for local jobs
+
+    def __init__(self, doc, func, args):
+        super().__init__(doc['user_id'], func, args, {})
+        self.id = str(doc['_id'])
+        self.doc = doc
+        self.created = doc['created_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.lost = False
+
+
+class JobWorker:
+    # Consumer side of the Mongo job queue, run by worker.py. Each of the
+    # `concurrency` loops claims one job at a time; a heartbeat renews the
+    # lease while it runs and stops the job if it was cancelled or the lease
+    # went to another worker.
+
+    def __init__(self, client, run, worker_id=WORKER_ID, concurrency=RENAME_WORKERS):
+        # run(client, doc) does the job and returns the produced file_id
+        self.client = client
+        self.run = run
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self._tasks = []
+        self._swept = 0.0
+        self.running = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+
+    @property
+    def alive(self):
+        # False once a claim loop died, for /healthz
+        return bool(self._tasks) and not any(task.done() for task in self._tasks)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self):
+        while True:
+            try:
+                doc = await db.claim_job(self.worker_id, JOB_LEASE)
+            except Exception as e:
+                logger.warning(f"claiming a job failed: {e}")
+                doc = None
+            if doc is None:
+                await self._sweep()
+                await asyncio.sleep(JOB_POLL)
+                continue
+            try:
+                await self._execute(doc)
+            except Exception:
+                # Whatever is left of the job is up to its lease; this loop
+                # keeps claiming
+                logger.exception(f"job {doc['_id']} of {doc['user_id']} could not be finished")
+
+    async def _sweep(self):
+        if time.monotonic() - self._swept < JOB_LEASE:
+            return
+        self._swept = time.monotonic()
+        try:
+            failed, cancelled = await db.fail_stale_jobs()
+        except Exception as e:
+            logger.warning(f"failing stale jobs failed: {e}")
+            return
+        if failed:
+            logger.warning(f"{failed} jobs failed after their last attempt")
+        if cancelled:
+            logger.info(f"{cancelled} cancelled jobs lost their worker")
+
+    async def _execute(self, doc):
+        job = QueuedJob(doc, self.run, (self.client, doc))
+        job.task = asyncio.create_task(job.run())
+        self.running += 1
+        beat = asyncio.create_task(self._heartbeat(job))
+        status, file_id = "failed", None
+        try:
+            await asyncio.wait([job.task])
+            if job.task.cancelled():
+                status = "cancelled"
+                logger.info(f"job {job.id} of {job.user_id} cancelled")
+            elif job.task.exception():
+                logger.error(f"job {job.id} of {job.user_id} failed", exc_info=job.task.exception())
+            elif job.task.result():
+                status, file_id = "done", job.task.result()
+            else:
+                # The source was gone, or the upload failed and the user was
+                # already told so
+                logger.warning(f"job {job.id} of {job.user_id} produced no file")
+        except asyncio.CancelledError:
+            # Worker shutting down: hand the job to another worker
+            job.task.cancel()
+            await asyncio.wait([job.task])
+            await db.release_job(doc['_id'], self.worker_id)
+            raise
+        finally:
+            self.running -= 1
+            beat.cancel()
+            job.set_done()
+        if not job.lost:
+            trace = job.trace.to_dict() if job.trace and job.trace.total is not None else None
+            await self._finish(job, status, file_id, trace)
+
+    async def _finish(self, job, status, file_id, trace):
+        # A job left "running" is run again once its lease expires, so keep
+        # trying while the lease still holds
+        deadline = time.monotonic() + JOB_LEASE - JOB_HEARTBEAT
+        while True:
+            try:
+                await db.finish_job(job.doc['_id'], self.worker_id, status, file_id, trace)
+                return
+            except Exception as e:
+                if time.monotonic() + JOB_HEARTBEAT > deadline:
+                    raise
+                logger.warning(f"finishing job {job.id} failed, retrying: {e}")
+            await asyncio.sleep(JOB_HEARTBEAT)
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT)
+            try:
+                doc = await db.heartbeat_job(job.doc['_id'], self.worker_id, JOB_LEASE)
+            except Exception as e:
+                # The lease is long enough to survive a few missed beats
+                logger.warning(f"heartbeat of job {job.id} failed: {e}")
+                continue
+            if doc is None:
+                logger.warning(f"job {job.id} lost its lease")
+                job.lost = True
+            if doc is None or doc.get('cancel'):
+                job.cancelled = True
+                job.task.cancel()
+                return
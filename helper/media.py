@@ -0,0 +1,37 @@
+import os
+from hachoir.metadata import extractMetadata
+from hachoir.parser import createParser
+from PIL import Image
+
+# Blocking media helpers. They run in the pool from helper.offload, so they
+# must stay plain module-level functions (picklable for a process pool).
+
+
+def read_meta(path: str):
+    width = height = duration = None
+    try:
+        parser = createParser(path)
+        if not parser:
+            return width, height, duration
+        with parser:
+            metadata = extractMetadata(parser)
+        if metadata:
+            if metadata.has("duration"):
+                duration = int(metadata.get("duration").seconds)
+            if metadata.has("width"):
+                width = int(metadata.get("width"))
+            if metadata.has("height"):
+                height = int(metadata.get("height"))
+    except Exception:
+        pass
+    return width, height, duration
+
+
+def normalize_thumb(path: str) -> dict:
+    # convert to JPEG, <= 320px, <= 200KB
+    im = Image.open(path).convert("RGB")
+    im.thumbnail((320, 320))
+    im.save(path, "JPEG", quality=85, optimize=True)
+    if os.path.getsize(path) > 200_000:
+        im.save(path, "JPEG", quality=70, optimize=True)
+    return dict(width=im.width, height=im.height, size=os.path.getsize(path))
@@ -0,0 +1,78 @@
+import time
+import asyncio
+from collections import OrderedDict
+from pyrogram import enums
+from pyrogram.errors import UserNotParticipant
+from config import FSUB_CACHE_TTL, FSUB_NEGATIVE_TTL, FSUB_CACHE_SIZE
+from helper.metrics import metrics
+
+
+class MembershipCache:
+    # Force-subscribe results per user. Members are cached for `ttl`,
+    # non-members only for `negative_ttl` so someone who just joined is let
+    # in soon. Concurrent checks for one user share a single get_chat_member.
+
+    def __init__(self, ttl, negative_ttl, size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self._data = OrderedDict()
+        self._pending = {}
+        # Users whose pending lookup started before an invalidate(); bounded
+        # by the lookups in flight
+        self._stale = set()
+
+    def get(self, user_id):
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        self._data.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, user_id, member):
+        ttl = self.ttl if member else self.negative_ttl
+        self._data[user_id] = (time.monotonic() + ttl, member)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._data.pop(user_id, None)
+        if user_id in self._pending:
+            self._stale.add(user_id)
+
+    async def is_member(self, client, channel, user_id):
+        member = self.get(user_id)
+        if member is not None:
+            metrics.inc("fsub_checks_total", result="hit")
+            return member
+        task = self._pending.get(user_id)
+        if task is not None:
+            metrics.inc("fsub_checks_total", result="coalesced")
+        else:
+            metrics.inc("fsub_checks_total", result="miss")
+            task = asyncio.create_task(self._lookup(client, channel, user_id))
+            self._pending[user_id] = task
+            task.add_done_callback(lambda _: self._done(user_id))
+        # One cancelled caller must not cancel the lookup the others wait for
+        return await asyncio.shield(task)
+
+    def _done(self, user_id):
+        self._pending.pop(user_id, None)
+        self._stale.discard(user_id)
+
+    async def _lookup(self, client, channel, user_id):
+        # Errors (FloodWait, bot no longer admin...) are raised, not cached
+        try:
+            user = await client.get_chat_member(channel, user_id)
+        except UserNotParticipant:
+            member = False
+        else:
+            member = user.status != enums.ChatMemberStatus.BANNED
+        # A lookup that raced with a membership update must not undo it
+        if user_id not in self._stale:
+            self.put(user_id, member)
+        return member
+
+
+membership = MembershipCache(FSUB_CACHE_TTL, FSUB_NEGATIVE_TTL, FSUB_CACHE_SIZE)
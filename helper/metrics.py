@@ -0,0 +1,129 @@
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Seconds; Mongo calls, Telegram calls, loop lag
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds; whole renames and broadcasts
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Metrics:
+    # Tiny in-process counter registry, cheap enough to bump on hot paths.
+    # Histograms keep per-bucket counts only; render() writes all of it in
+    # the Prometheus text format for /metrics.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._gauge_funcs = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    def total(self, name):
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        # Up/down gauge, e.g. transfers in progress
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def gauge(self, name, func):
+        # Gauge read from func() when /metrics is scraped
+        self._gauge_funcs[name] = func
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            h[1][bisect_left(h[0], value)] += 1
+            h[2] += value
+
+    @contextmanager
+    def timer(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, buckets, **labels)
+
+    def render(self):
+        lines = []
+
+        def labels(pairs, extra=()):
+            pairs = tuple(pairs) + tuple(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        def family(kind, items):
+            seen = set()
+            for (name, pairs), value in sorted(items, key=lambda i: (i[0][0], str(i[0][1]))):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                yield name, pairs, value
+
+        with self._lock:
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+            histograms = [(k, (h[0], list(h[1]), h[2])) for k, h in self.histograms.items()]
+        for name, func in self._gauge_funcs.items():
+            try:
+                gauges.append(((name, ()), func()))
+            except Exception as e:
+                logger.warning(f"gauge {name} failed: {e}")
+
+        for name, pairs, value in family("counter", counters):
+            lines.append(f"{name}{labels(pairs)} {value}")
+        for name, pairs, value in family("gauge", gauges):
+            lines.append(f"{name}{labels(pairs)} {value}")
+        for name, pairs, (buckets, counts, total) in family("histogram", histograms):
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{labels(pairs, [('le', bound)])} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{name}_bucket{labels(pairs, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{labels(pairs)} {total}")
+            lines.append(f"{name}_count{labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+async def watch_loop_lag(interval, warn):
+    # How late a sleep(interval) wakes up is how long something blocked the
+    # event loop; kept as a histogram plus the last value for /healthz
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(time.monotonic() - start - interval, 0)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set("event_loop_lag_last_seconds", lag)
+        if lag > warn:
+            logger.warning(f"event loop was blocked for {lag:.2f}s")
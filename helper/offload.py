@@ -0,0 +1,29 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import MEDIA_POOL, MEDIA_WORKERS, MEDIA_TIMEOUT
+
+_pool = None
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        if MEDIA_POOL == "process":
+            _pool = ProcessPoolExecutor(max_workers=MEDIA_WORKERS)
+        else:
+            _pool = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+    return _pool
+
+
+async def run_blocking(func, *args, timeout=MEDIA_TIMEOUT):
+    # Keeps CPU-bound media work (hachoir, PIL) off the event loop. On timeout
+    # the caller stops waiting; the worker finishes in the background.
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(_executor(), func, *args), timeout)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,360 @@
+import io
+import os
+import time
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from helper.media import read_meta
+from helper.metrics import metrics
+from helper.offload import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Header-only probing of width/height/duration. Only the container headers
+# are read (MP4 moov, Matroska Info/Tracks, MP3 first frame), with seeks
+# instead of scanning, so a multi-GB file costs a few KB of reads in the
+# common case. Anything unrecognised falls back to hachoir.
+
+MAX_HEADER = 32 * 1024 * 1024
+
+
+class _Reader:
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, n):
+        data = self.f.read(n)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+
+# -- MP4 / MOV / M4A ---------------------------------------------------------
+
+def _boxes(data, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, min(offset + size, end)
+        offset += size
+
+
+def _parse_moov(data):
+    width = height = duration = None
+    for kind, start, end in _boxes(data, 0, len(data)):
+        if kind == b"mvhd":
+            if data[start] == 1:
+                timescale, length = struct.unpack(">IQ", data[start + 20:start + 32])
+            else:
+                timescale, length = struct.unpack(">II", data[start + 12:start + 20])
+            if timescale:
+                duration = int(length / timescale)
+        elif kind == b"trak" and width is None:
+            for sub, s, e in _boxes(data, start, end):
+                if sub == b"tkhd" and e - s >= 8:
+                    w, h = struct.unpack(">II", data[e - 8:e])
+                    if w >> 16 and h >> 16:
+                        width, height = w >> 16, h >> 16
+    return width, height, duration
+
+
+def _mp4(f, size):
+    offset = 0
+    while offset + 8 <= size:
+        f.seek(offset)
+        box_size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if box_size == 1:
+            box_size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < header:
+            return None
+        if kind == b"moov":
+            if box_size > MAX_HEADER:
+                return None
+            return _parse_moov(f.read(box_size - header))
+        offset += box_size
+    return None
+
+
+# -- Matroska / WebM ---------------------------------------------------------
+
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+INFO = 0x1549A966
+TRACKS = 0x1654AE6B
+CLUSTER = 0x1F43B675
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACK_ENTRY = 0xAE
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+
+
+def _ebml_id(f):
+    first = f.read(1)
+    if not first:
+        return None
+    b = first[0]
+    length = 1
+    while length <= 4 and not b & (0x80 >> (length - 1)):
+        length += 1
+    if length > 4:
+        return None
+    return int.from_bytes(first + f.read(length - 1), "big")
+
+
+def _ebml_size(f):
+    first = f.read(1)
+    if not first:
+        return None
+    b = first[0]
+    length = 1
+    while length <= 8 and not b & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        return None
+    value = b & (0xFF >> length)
+    rest = f.read(length - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    if value == (1 << (7 * length)) - 1:
+        return -1  # unknown size
+    return value
+
+
+def _ebml_children(data):
+    f = io.BytesIO(data)
+    while f.tell() < len(data):
+        eid = _ebml_id(f)
+        size = _ebml_size(f)
+        if eid is None or size is None or size < 0:
+            return
+        yield eid, f.read(size)
+
+
+def _uint(data):
+    return int.from_bytes(data, "big")
+
+
+def _mkv(f, size):
+    if _ebml_id(f) != EBML_HEADER:
+        return None
+    header = _ebml_size(f)
+    if header is None or header < 0:
+        return None
+    f.seek(header, 1)
+    if _ebml_id(f) != SEGMENT:
+        return None
+    _ebml_size(f)
+    width = height = duration = None
+    scale = 1000000
+    seen = 0
+    while seen < 2 and f.tell() < size:
+        eid = _ebml_id(f)
+        length = _ebml_size(f)
+        if eid is None or length is None or length < 0 or eid == CLUSTER:
+            break
+        if eid == INFO and length <= MAX_HEADER:
+            seen += 1
+            raw_duration = None
+            for cid, value in _ebml_children(f.read(length)):
+                if cid == TIMECODE_SCALE:
+                    scale = _uint(value)
+                elif cid == DURATION:
+                    raw_duration = struct.unpack(">f" if len(value) == 4 else ">d", value)[0]
+            if raw_duration is not None:
+                duration = int(raw_duration * scale / 1e9)
+        elif eid == TRACKS and length <= MAX_HEADER:
+            seen += 1
+            for cid, entry in _ebml_children(f.read(length)):
+                if cid != TRACK_ENTRY or width is not None:
+                    continue
+                for tid, video in _ebml_children(entry):
+                    if tid != VIDEO:
+                        continue
+                    for vid, value in _ebml_children(video):
+                        if vid == PIXEL_WIDTH:
+                            width = _uint(value)
+                        elif vid == PIXEL_HEIGHT:
+                            height = _uint(value)
+        else:
+            f.seek(length, 1)
+    if width is None and duration is None:
+        return None
+    return width, height, duration
+
+
+# -- MP3 ---------------------------------------------------------------------
+
+_MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _mp3(f, size):
+    start = 0
+    head = f.read(10)
+    if head[:3] == b"ID3":
+        tag = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        start = tag + (20 if head[5] & 0x10 else 10)
+    f.seek(start)
+    data = f.read(4096)
+    for i in range(len(data) - 4):
+        if data[i] == 0xFF and data[i + 1] & 0xE0 == 0xE0:
+            break
+    else:
+        return None
+    b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    if version == 1 or layer != 1:
+        return None
+    bitrate = _MP3_BITRATES[3 if version == 3 else 2][b2 >> 4] if (b2 >> 4) < 15 else 0
+    rate_index = (b2 >> 2) & 3
+    if not bitrate or rate_index == 3:
+        return None
+    sample_rate = _MP3_RATES[version][rate_index]
+    mono = (b3 >> 6) == 3
+    if version == 3:
+        side = 17 if mono else 32
+        samples = 1152
+    else:
+        side = 9 if mono else 17
+        samples = 576
+    xing = data[i + 4 + side:i + 4 + side + 12]
+    if xing[:4] in (b"Xing", b"Info") and struct.unpack(">I", xing[4:8])[0] & 1:
+        frames = struct.unpack(">I", xing[8:12])[0]
+        return None, None, int(frames * samples / sample_rate)
+    return None, None, int((size - start - i) * 8 / (bitrate * 1000))
+
+
+def probe_headers(path: str):
+    # (width, height, duration, bytes_read), or None if the format is unknown
+    size = os.path.getsize(path)
+    with open(path, "rb") as raw:
+        f = _Reader(raw)
+        magic = f.read(12)
+        f.seek(0)
+        try:
+            if magic[:4] == b"\x1aE\xdf\xa3":
+                meta = _mkv(f, size)
+            elif magic[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip"):
+                meta = _mp4(f, size)
+            elif magic[:3] == b"ID3" or (magic[:1] == b"\xff" and magic[1] & 0xE0 == 0xE0):
+                meta = _mp3(f, size)
+            else:
+                meta = None
+        except Exception:
+            # A malformed header is left to hachoir rather than failing the job
+            meta = None
+    if meta is None:
+        return None
+    return (*meta, f.bytes_read)
+
+
+def probe(path: str):
+    # ((width, height, duration), method, header bytes read); runs in the
+    # media pool, so the caller records the metrics
+    found = probe_headers(path)
+    if found and found[2]:
+        return found[:3], "headers", found[3]
+    return read_meta(path), "hachoir", found[3] if found else 0
+
+
+class ProbeCache:
+    # Results per Telegram file_unique_id: the same source file renamed again
+    # (another name, or sent as video and then as audio) is not probed twice
+
+    def __init__(self, size=256):
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        meta = self._data.get(key)
+        if meta is not None:
+            self._data.move_to_end(key)
+        return meta
+
+    def put(self, key, meta):
+        self._data[key] = meta
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+
+probe_cache = ProbeCache()
+
+
+async def probe_file(path: str, unique_id=None):
+    meta = probe_cache.get(unique_id) if unique_id else None
+    if meta is not None:
+        metrics.inc("probe_total", method="cache")
+        return meta
+    start = time.perf_counter()
+    try:
+        meta, method, bytes_read = await run_blocking(probe, path)
+    except asyncio.TimeoutError:
+        metrics.inc("probe_total", method="timeout")
+        return None, None, None
+    except Exception as e:
+        # The file is still sent, just without the attributes
+        logger.warning(f"probing {path} failed: {e}")
+        metrics.inc("probe_total", method="error")
+        return None, None, None
+    metrics.inc("probe_total", method=method)
+    metrics.inc("probe_bytes_read_total", bytes_read, method=method)
+    metrics.observe("probe_seconds", time.perf_counter() - start, method=method)
+    if unique_id:
+        probe_cache.put(unique_id, meta)
+    return meta
+
+
+# Attributes each output type needs
+NEEDED = {"document": (), "video": ("width", "height", "duration"), "audio": ("duration",)}
+
+
+def message_meta(src, kind):
+    # (width, height, duration) as Telegram already reports them for the
+    # source file, or None if they don't cover what `kind` needs
+    media = getattr(src, src.media.value, None) if src.media else None
+    found = {f: getattr(media, f, None) for f in ("width", "height", "duration")}
+    if not all(found[f] for f in NEEDED[kind]):
+        return None
+    return found["width"], found["height"], found["duration"]
+
+
+async def resolve_meta(src, kind, path=None):
+    # Prefer the source message; probe the file only for what it lacks,
+    # e.g. a document being sent as a video
+    meta = message_meta(src, kind)
+    if meta is not None:
+        metrics.inc("media_meta_total", source="message")
+        return meta
+    if path is None:
+        metrics.inc("media_meta_total", source="missing")
+        return None, None, None
+    metrics.inc("media_meta_total", source="probe")
+    media = getattr(src, src.media.value, None) if src.media else None
+    return await probe_file(path, getattr(media, "file_unique_id", None))
@@ -0,0 +1,100 @@
+import math
+import time
+import asyncio
+from pyrogram.errors import FloodWait
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from config import PROGRESS_INTERVAL, PROGRESS_EDITS_PER_SEC
+from helper.txt import mr
+from helper.utils import humanbytes, TimeFormatter
+from helper.metrics import metrics
+from helper.ratelimit import TokenBucket
+from helper.scheduler import current_job, check_cancelled
+
+# Shared by every running job so all progress bars together stay under
+# Telegram's edit limits
+edit_limiter = TokenBucket(PROGRESS_EDITS_PER_SEC)
+
+
+class Progress:
+    # Progress callback for download_media/send_*/stream_upload. update() only
+    # records the latest numbers; a background task edits the message at most
+    # once every PROGRESS_INTERVAL seconds, so the transfer never waits on it.
+
+    def __init__(self, message, title, start=None, markup=None):
+        self.message = message
+        self.title = title
+        self.start = start or time.time()
+        job = current_job.get()
+        self.markup = markup or InlineKeyboardMarkup([[
+            InlineKeyboardButton("✖️ 𝙲𝙰𝙽𝙲𝙴𝙻 ✖️", callback_data=f"cancel_{job.id}" if job else "cancel")
+        ]])
+        self.current = 0
+        self.total = 0
+        self._version = 0
+        self._rendered = 0
+        self._last_text = None
+        self._last_edit = 0.0
+        self._task = None
+
+    async def update(self, current, total, *args):
+        check_cancelled()
+        self.current, self.total = current, total
+        self._version += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def close(self):
+        # Must be called before the message is edited/deleted by the job
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def render(self):
+        diff = max(time.time() - self.start, 0.1)
+        total = self.total or 1
+        percentage = min(self.current * 100 / total, 100)
+        speed = self.current / diff
+        eta = round((total - self.current) / speed) * 1000 if speed else 0
+        bar = "{0}{1}".format(
+            "█" * math.floor(percentage / 5),
+            "░" * (20 - math.floor(percentage / 5)))
+        return "{}\n\n{}".format(self.title, bar + mr.PROGRESS_BAR.format(
+            round(percentage, 2),
+            humanbytes(self.current),
+            humanbytes(self.total),
+            humanbytes(speed),
+            TimeFormatter(milliseconds=eta) or "0 s"
+        ))
+
+    async def _flush(self):
+        while self._rendered != self._version:
+            wait = self._last_edit + PROGRESS_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            version = self._version
+            if version - self._rendered > 1:
+                metrics.inc("progress_updates_total", version - self._rendered - 1, result="coalesced")
+            self._rendered = version
+            text = self.render()
+            if text == self._last_text:
+                metrics.inc("progress_updates_total", result="identical")
+                continue
+            await edit_limiter.acquire()
+            try:
+                await self.message.edit(text=text, reply_markup=self.markup)
+            except FloodWait as e:
+                edit_limiter.pause(e.value)
+                metrics.inc("flood_waits_total", source="progress")
+                self._last_edit = time.monotonic() + e.value
+                self._rendered = version - 1
+                metrics.inc("progress_updates_total", result="flood_wait")
+                continue
+            except Exception:
+                metrics.inc("progress_updates_total", result="failed")
+            else:
+                metrics.inc("progress_updates_total", result="sent")
+                self._last_text = text
+            self._last_edit = time.monotonic()
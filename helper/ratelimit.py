@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    # Classic token bucket; pause() lets callers respect a FloodWait for
+    # everybody sharing the bucket, not just the request that hit it.
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def try_acquire(self):
+        now = self._refill()
+        if now < self.paused_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    # Starts at the configured rate, backs off hard whenever Telegram answers
+    # with FloodWait and creeps back up while sends keep succeeding.
+
+    def __init__(self, rate, burst=None, min_rate=1.0):
+        super().__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = min_rate
+
+    def on_flood(self, seconds):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.pause(seconds)
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 0.05)
@@ -0,0 +1,217 @@
+import time
+import asyncio
+import itertools
+import logging
+import contextvars
+from collections import OrderedDict, deque
+from config import RENAME_WORKERS, USER_CONCURRENCY, MAX_QUEUE, USER_QUEUE, JOB_BACKEND
+from helper.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_job_ids = itertools.count(1)
+
+# The job the current task is running for, inherited by the tasks it spawns
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UserQueueFull(QueueFull):
+    # This user already has USER_QUEUE jobs waiting
+    pass
+
+
+class JobCancelled(asyncio.CancelledError):
+    # A CancelledError, so the job's `except Exception` blocks let it through
+    pass
+
+
+def check_cancelled():
+    # Cancellation token check for transfer loops and progress callbacks
+    job = current_job.get()
+    if job is not None and job.cancelled:
+        raise JobCancelled(f"job {job.id} cancelled")
+
+
+class Job:
+
+    def __init__(self, user_id, func, args, kwargs):
+        self.id = next(_job_ids)
+        self.user_id = int(user_id)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = asyncio.Event()
+        self.cancelled = False
+        self.task = None
+        self.created = time.time()
+        self.trace = None
+        self._callbacks = []
+
+    async def run(self):
+        current_job.set(self)
+        return await self.func(*self.args, **self.kwargs)
+
+    def add_done_callback(self, fn):
+        # fn(job) runs once the job is over, whether it ran, failed or was
+        # dropped from the queue before it started
+        self._callbacks.append(fn)
+
+    def set_done(self):
+        if self.done.is_set():
+            return
+        self.done.set()
+        for fn in self._callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception(f"done callback of job {self.id} failed")
+
+
+class JobScheduler:
+    # Heavy rename jobs run on a fixed pool of worker tasks instead of inside
+    # the pyrogram handler, so /start, thumbnails etc. never wait behind them.
+    # Pending jobs are kept per user and picked round-robin, which keeps a user
+    # with 40 files from starving everyone else.
+
+    def __init__(self, workers, per_user, max_queue, user_queue):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.user_queue = user_queue
+        self._pending = OrderedDict()
+        self._running = {}
+        self._jobs = {}
+        self._size = 0
+        self._cond = None
+        self._tasks = []
+
+    @property
+    def queued(self):
+        return self._size
+
+    @property
+    def active(self):
+        return sum(self._running.values())
+
+    def start(self):
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def queued_for(self, user_id):
+        return len(self._pending.get(int(user_id), ()))
+
+    async def submit(self, user_id, func, *args, **kwargs):
+        if self._size >= self.max_queue:
+            raise QueueFull()
+        if self.queued_for(user_id) >= self.user_queue:
+            raise UserQueueFull()
+        job = Job(user_id, func, args, kwargs)
+        async with self._cond:
+            self._pending.setdefault(job.user_id, deque()).append(job)
+            self._size += 1
+            self._jobs[job.id] = job
+            self._cond.notify()
+        return job
+
+    async def cancel(self, job):
+        # Queued jobs are dropped; a running job has its token set and its
+        # task cancelled, which interrupts whatever transfer it is awaiting.
+        # Returns once the job has unwound and its slot and files are freed.
+        if job.done.is_set():
+            return False
+        job.cancelled = True
+        async with self._cond:
+            queue = self._pending.get(job.user_id)
+            if queue and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self._pending[job.user_id]
+                self._size -= 1
+                self._jobs.pop(job.id, None)
+                job.set_done()
+                return True
+        if job.task:
+            job.task.cancel()
+        await job.done.wait()
+        return True
+
+    def position(self, job):
+        # Number of jobs that will be started before this one, or None once
+        # it is no longer waiting
+        queue = self._pending.get(job.user_id)
+        if not queue or job not in queue:
+            return None
+        index = queue.index(job)
+        ahead = index
+        before = True
+        for uid, other in self._pending.items():
+            if uid == job.user_id:
+                before = False
+                continue
+            # users ahead of us in the rotation get one extra turn
+            ahead += min(len(other), index + 1 if before else index)
+        return ahead
+
+    def _next_job(self):
+        for uid, queue in self._pending.items():
+            if self._running.get(uid, 0) >= self.per_user:
+                continue
+            job = queue.popleft()
+            if queue:
+                self._pending.move_to_end(uid)
+            else:
+                del self._pending[uid]
+            self._size -= 1
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                job = self._next_job()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._next_job()
+                self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+            # Each job gets its own task, so cancelling it leaves the worker alive
+            job.task = asyncio.create_task(job.run())
+            try:
+                await asyncio.wait([job.task])
+                if job.task.cancelled():
+                    logger.info(f"job {job.id} of {job.user_id} cancelled")
+                elif job.task.exception():
+                    logger.error(f"job {job.id} of {job.user_id} failed", exc_info=job.task.exception())
+            except asyncio.CancelledError:
+                job.task.cancel()
+                await asyncio.wait([job.task])
+                raise
+            finally:
+                self._jobs.pop(job.id, None)
+                job.set_done()
+                async with self._cond:
+                    self._running[job.user_id] -= 1
+                    if not self._running[job.user_id]:
+                        del self._running[job.user_id]
+                    self._cond.notify_all()
+
+
+scheduler = JobScheduler(RENAME_WORKERS, USER_CONCURRENCY, MAX_QUEUE, USER_QUEUE)
+if JOB_BACKEND == "local":
+    # With the mongo backend /metrics of the bot reads these from the queue
+    metrics.gauge("rename_jobs_queued", lambda: scheduler.queued)
+    metrics.gauge("rename_jobs_running", lambda: scheduler.active)
@@ -0,0 +1,121 @@
+import os
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+from config import THUMB_CACHE_DIR, THUMB_CACHE_SIZE
+from helper.database import db
+from helper.media import normalize_thumb
+from helper.metrics import metrics
+from helper.offload import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbCache:
+    # Ready-to-upload JPEG thumbnails on local disk, keyed by the file_id the
+    # user saved. Bounded by total size, least recently used goes first.
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        os.makedirs(root, exist_ok=True)
+        files = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith(".jpg") and os.path.isfile(path):
+                st = os.stat(path)
+                files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def _name(file_id):
+        return hashlib.sha1(file_id.encode()).hexdigest() + ".jpg"
+
+    def get(self, file_id):
+        name = self._name(file_id)
+        if name not in self._entries:
+            metrics.inc("thumb_cache_total", result="miss")
+            return None
+        self._entries.move_to_end(name)
+        metrics.inc("thumb_cache_total", result="hit")
+        return os.path.join(self.root, name)
+
+    def put(self, file_id, src):
+        name = self._name(file_id)
+        path = os.path.join(self.root, name)
+        tmp = path + ".part"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, path)
+        self.size += os.path.getsize(path) - self._entries.get(name, 0)
+        self._entries[name] = os.path.getsize(path)
+        self._entries.move_to_end(name)
+        self._evict()
+        return path
+
+    def invalidate(self, file_id):
+        if file_id:
+            self._remove(self._name(file_id))
+
+    def link_into(self, file_id, dest):
+        # Give a job its own link to the cached file, so eviction while the
+        # upload is running cannot pull the file from under it
+        path = self.get(file_id)
+        if not path:
+            return None
+        try:
+            os.link(path, dest)
+        except OSError:
+            try:
+                shutil.copyfile(path, dest)
+            except OSError:
+                self._remove(self._name(file_id))
+                return None
+        return dest
+
+    def _remove(self, name):
+        size = self._entries.pop(name, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(os.path.join(self.root, name))
+        except OSError as e:
+            logger.warning(f"could not remove cached thumb {name}: {e}")
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+
+thumbs = ThumbCache(THUMB_CACHE_DIR, THUMB_CACHE_SIZE)
+
+
+async def store_thumb(client, file_id, path):
+    # Save-time pipeline: fetch the photo once, make it Telegram compliant
+    # off the event loop and keep the result in Mongo and the local cache
+    await client.download_media(file_id, file_name=path)
+    meta = await run_blocking(normalize_thumb, path)
+    with open(path, "rb") as f:
+        await db.save_thumb(file_id, f.read())
+    thumbs.put(file_id, path)
+    return meta
+
+
+async def fetch_thumb(client, file_id, path):
+    # Ready JPEG for an upload: local cache, then Mongo, and only for
+    # thumbnails saved before store_thumb existed the full pipeline
+    if thumbs.link_into(file_id, path):
+        return path
+    data = await db.get_thumb(file_id)
+    if data:
+        with open(path, "wb") as f:
+            f.write(data)
+        thumbs.put(file_id, path)
+        return path
+    await store_thumb(client, file_id, path)
+    return path
@@ -0,0 +1,151 @@
+import sys
+import time
+import random
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+from config import TRACE_KEEP, PROFILE_RATE, PROFILE_INTERVAL
+from helper.metrics import metrics
+
+# Seconds; from a thumbnail lookup to a multi-GB download
+STAGE_BUCKETS = (0.05, 0.25, 1, 5, 15, 60, 300, 1800)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Span:
+
+    def __init__(self, stage, offset, attrs):
+        self.stage = stage
+        self.offset = offset
+        self.duration = None
+        self.attrs = attrs
+
+
+class Trace:
+    # Stage timings of one rename job. Transfer code reports retries,
+    # FloodWait sleeps etc. with note(), which lands on the open span.
+
+    def __init__(self, job_id, user_id, name, size=0, queued=0.0):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.name = name
+        self.size = size
+        self.started = time.time()
+        self.total = None
+        self.result = None
+        self.spans = []
+        self.profile = None
+        self._open = None
+        if queued:
+            # Time between submit and a worker picking the job up
+            span = Span("queue", -queued, {})
+            span.duration = queued
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        span = Span(stage, time.time() - self.started, attrs)
+        self.spans.append(span)
+        outer, self._open = self._open, span
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            self._open = outer
+            metrics.observe("rename_stage_seconds", span.duration, STAGE_BUCKETS, stage=stage)
+
+    def note(self, key, value=1):
+        if self._open is not None:
+            self._open.attrs[key] = self._open.attrs.get(key, 0) + value
+
+    def finish(self, result):
+        self.total = time.time() - self.started
+        self.result = result
+        recent_traces.append(self)
+
+    def to_dict(self):
+        return dict(
+            job_id=str(self.job_id),
+            user_id=self.user_id,
+            name=self.name,
+            size=self.size,
+            started=self.started,
+            total=self.total,
+            result=self.result,
+            spans=[dict(stage=s.stage, offset=s.offset, duration=s.duration, **s.attrs) for s in self.spans],
+            profile=self.profile
+        )
+
+
+# Finished traces, newest last
+recent_traces = deque(maxlen=TRACE_KEEP)
+
+
+def note(key, value=1):
+    # Add to the open span of the current job's trace, if there is one
+    trace = current_trace.get()
+    if trace is not None:
+        trace.note(key, value)
+
+
+@contextmanager
+def span(stage, **attrs):
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(stage, **attrs) as s:
+        yield s
+
+
+def slowest(n=10):
+    return [t.to_dict() for t in sorted(recent_traces, key=lambda t: t.total, reverse=True)[:n]]
+
+
+class StackSampler(threading.Thread):
+    # Sampling profiler for one job: every PROFILE_INTERVAL ms it records the
+    # stack the event loop thread is running. The loop is shared, so samples
+    # from other jobs running at the same time show up too.
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self, top=20):
+        # Most frequent stacks, in the folded format flamegraph tools read
+        self._halt.set()
+        self.join()
+        return [f"{stack} {count}" for stack, count in self.samples.most_common(top)]
+
+
+@contextmanager
+def trace_job(job_id, user_id, name, size=0, queued=0.0):
+    trace = Trace(job_id, user_id, name, size, queued)
+    token = current_trace.set(trace)
+    sampler = None
+    if PROFILE_RATE and random.random() < PROFILE_RATE:
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL / 1000)
+        sampler.start()
+    try:
+        yield trace
+    finally:
+        if sampler is not None:
+            trace.profile = sampler.stop()
+        current_trace.reset(token)
@@ -0,0 +1,278 @@
+import os
+import mmap
+import asyncio
+import logging
+import math
+from hashlib import md5
+from pyrogram import Client, raw, types, utils
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from helper.scheduler import check_cancelled
+from helper.metrics import metrics
+from helper import tracing
+from config import STREAM_BUFFER, DOWNLOAD_PARALLELISM, UPLOAD_SESSIONS, UPLOAD_WINDOW, UPLOAD_RETRIES
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024
+BIG_FILE = 10 * 1024 * 1024
+# stream_media always yields (and counts offset/limit in) 1 MB chunks
+CHUNK_SIZE = 1024 * 1024
+
+
+async def _media_session(client: Client) -> Session:
+    session = Session(
+        client,
+        await client.storage.dc_id(),
+        await client.storage.auth_key(),
+        await client.storage.test_mode(),
+        is_media=True
+    )
+    await session.start()
+    return session
+
+
+async def parallel_download(
+    client: Client,
+    message,
+    path: str,
+    file_size: int,
+    parallelism: int = DOWNLOAD_PARALLELISM,
+    progress=None,
+    progress_args=()
+):
+    # Split the file into `parallelism` contiguous ranges and fetch each with
+    # a single ranged stream_media call, writing its chunks with os.pwrite at
+    # their final offset in a preallocated file. Every stream_media call opens
+    # its own media session (and, for a file on another DC, exports and
+    # imports the authorization), so there is one call per range rather than
+    # one per few MB; only a range that came back short is resumed.
+    chunks = math.ceil(file_size / CHUNK_SIZE)
+    per_range = max(1, math.ceil(chunks / max(1, min(parallelism, chunks))))
+    ranges = [(i, min(per_range, chunks - i)) for i in range(0, chunks, per_range)]
+    received = 0
+
+    async def worker(first, count):
+        nonlocal received
+        expected = min(count * CHUNK_SIZE, file_size - first * CHUNK_SIZE)
+        got = 0
+        for _ in range(3):
+            start = first + got // CHUNK_SIZE
+            async for chunk in client.stream_media(message, limit=count - got // CHUNK_SIZE, offset=start):
+                check_cancelled()
+                os.pwrite(fd, chunk, first * CHUNK_SIZE + got)
+                metrics.inc("transfer_bytes_total", len(chunk), direction="download")
+                got += len(chunk)
+                received += len(chunk)
+                if progress:
+                    await progress(received, file_size, *progress_args)
+            if got >= expected:
+                break
+            # get_file logs and swallows errors (FloodWait included), which
+            # only shows up here as a short range
+            logger.warning(f"range at chunk {first} short by {expected - got} bytes, resuming")
+            tracing.note("retries")
+        if got != expected:
+            raise IOError(f"range at chunk {first}: got {got} of {expected} bytes")
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    metrics.add("transfers_active", 1, direction="download")
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, file_size)
+        else:
+            os.ftruncate(fd, file_size)
+        workers = [asyncio.create_task(worker(first, count)) for first, count in ranges]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        if received != file_size or os.fstat(fd).st_size != file_size:
+            raise IOError(f"downloaded {received} of {file_size} bytes")
+    finally:
+        metrics.add("transfers_active", -1, direction="download")
+        os.close(fd)
+    return path
+
+
+def _part_rpc(file_id, part, total_parts, data, is_big):
+    if is_big:
+        return raw.functions.upload.SaveBigFilePart(
+            file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=data
+        )
+    return raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+
+
+async def upload_file(client: Client, path: str, file_name: str, progress=None, progress_args=()):
+    # Parallel replacement for Client.save_file: the file is memory-mapped,
+    # up to UPLOAD_WINDOW parts are in flight at once, spread over a pool of
+    # UPLOAD_SESSIONS media sessions, and a failed part is retried on its own
+    # instead of failing the whole upload.
+    file_size = os.path.getsize(path)
+    if not file_size:
+        raise ValueError("File size equals to 0 B")
+    is_big = file_size > BIG_FILE
+    total_parts = math.ceil(file_size / PART_SIZE)
+    file_id = client.rnd_id()
+    sessions = [await _media_session(client) for _ in range(UPLOAD_SESSIONS if is_big else 1)]
+    sent = 0
+    metrics.add("transfers_active", 1, direction="upload")
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            md5_sum = None if is_big else md5(mm).hexdigest()
+            parts = iter(range(total_parts))
+
+            async def worker():
+                nonlocal sent
+                for part in parts:
+                    check_cancelled()
+                    data = mm[part * PART_SIZE:(part + 1) * PART_SIZE]
+                    session = sessions[part % len(sessions)]
+                    for attempt in range(UPLOAD_RETRIES):
+                        try:
+                            await session.invoke(_part_rpc(file_id, part, total_parts, data, is_big))
+                            break
+                        except FloodWait as e:
+                            metrics.inc("flood_waits_total", source="upload")
+                            tracing.note("flood_wait_seconds", e.value)
+                            await asyncio.sleep(e.value)
+                        except Exception as e:
+                            if attempt == UPLOAD_RETRIES - 1:
+                                raise
+                            logger.warning(f"part {part} of {file_name} failed ({e}), retrying")
+                            tracing.note("retries")
+                            await asyncio.sleep(1)
+                    else:
+                        raise IOError(f"part {part} of {file_name} was not accepted")
+                    sent += len(data)
+                    metrics.inc("transfer_bytes_total", len(data), direction="upload")
+                    if progress:
+                        await progress(sent, file_size, *progress_args)
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(UPLOAD_WINDOW, total_parts))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+    finally:
+        metrics.add("transfers_active", -1, direction="upload")
+        for session in sessions:
+            await session.stop()
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum=md5_sum)
+
+
+async def stream_upload(client: Client, message, file_name: str, file_size: int, progress=None, progress_args=()):
+    # Pipe the source file straight from Telegram back to Telegram. Chunks from
+    # stream_media go through a bounded queue, so the upload of part N overlaps
+    # the download of part N+1 and at most STREAM_BUFFER MB sit in memory.
+    queue = asyncio.Queue(maxsize=STREAM_BUFFER)
+
+    async def producer():
+        try:
+            async for chunk in client.stream_media(message):
+                check_cancelled()
+                metrics.inc("transfer_bytes_total", len(chunk), direction="download")
+                await queue.put(chunk)
+        except BaseException:
+            # The consumer may be gone too, so the end marker must not wait
+            # for a free slot; what is still buffered is useless anyway
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+            raise
+        await queue.put(None)
+
+    is_big = file_size > BIG_FILE
+    total_parts = math.ceil(file_size / PART_SIZE)
+    file_id = client.rnd_id()
+    md5_sum = None if is_big else md5()
+    session = await _media_session(client)
+    reader = asyncio.create_task(producer())
+    metrics.add("transfers_active", 1, direction="stream")
+    try:
+        buffer = bytearray()
+        part = 0
+        done = False
+        while not done:
+            chunk = await queue.get()
+            check_cancelled()
+            if chunk is None:
+                done = True
+            else:
+                buffer += chunk
+            while len(buffer) >= PART_SIZE or (done and buffer):
+                data = bytes(buffer[:PART_SIZE])
+                del buffer[:PART_SIZE]
+                if not is_big:
+                    md5_sum.update(data)
+                await session.invoke(_part_rpc(file_id, part, total_parts, data, is_big))
+                metrics.inc("transfer_bytes_total", len(data), direction="upload")
+                part += 1
+                if progress:
+                    await progress(min(part * PART_SIZE, file_size), file_size, *progress_args)
+        await reader
+        if part != total_parts:
+            raise IOError(f"stream ended after {part} of {total_parts} parts")
+    finally:
+        metrics.add("transfers_active", -1, direction="stream")
+        # Wait for the producer to really end, so it gives back its
+        # transmission slot and media session
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await session.stop()
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum=md5_sum.hexdigest())
+
+
+async def send_uploaded(
+    client: Client,
+    chat_id: int,
+    kind: str,
+    file,
+    file_name: str,
+    caption: str = "",
+    thumb: str = None,
+    width: int = None,
+    height: int = None,
+    duration: int = None,
+    reply_to_message_id: int = None
+):
+    # Equivalent of send_document/send_video/send_audio for a file that has
+    # already been uploaded with one of the helpers above.
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if kind == "video":
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            duration=duration or 0, w=width or 0, h=height or 0, supports_streaming=True
+        ))
+    elif kind == "audio":
+        attributes.insert(0, raw.types.DocumentAttributeAudio(duration=duration or 0))
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=client.guess_mime_type(file_name) or "application/zip",
+        file=file,
+        force_file=True if kind == "document" else None,
+        thumb=await client.save_file(thumb) if thumb else None,
+        attributes=attributes
+    )
+    r = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=media,
+            reply_to_msg_id=reply_to_message_id,
+            random_id=client.rnd_id(),
+            **await utils.parse_text_entities(client, caption, None, None)
+        )
+    )
+    for i in r.updates:
+        if isinstance(i, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, i.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
@@ -64,6 +64,10 @@ Example:- /set_caption 📕 File Name: {filename}
 
 ✏️ <b><u>HOW TO RENAME A FILE</u></b>
 •> send any file and click rename option and type new file name and \n send select [ document, video, audio ]👈 choice this.
+
+📦 <b><u>HOW TO RENAME MANY FILES</u></b>
+•> /batch video {title} S01E{n:02} {quality}.{ext} - start a batch with a naming template
+•> send all the files, then /done
 ℹ️ 𝗔𝗻𝘆 𝗢𝘁𝗵𝗲𝗿 𝗛𝗲𝗹𝗽 𝗖𝗼𝗻𝘁𝗮𝗰𝘁 :- <a href=https://www.instagram.com/LazyDeveloperrr>Direct Message</a>
 """
 
@@ -1,47 +1,4 @@
-import math
-import time 
-from helper.txt import mr
-from pyrogram.errors import UserNotParticipant
-from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from pyrogram import enums
-
-async def progress_for_pyrogram(current, total, ud_type, message, start):
-
-    now = time.time()
-    diff = now - start
-    if round(diff % 10.00) == 0 or current == total:
-        # if round(current / total * 100, 0) % 5 == 0:
-        percentage = current * 100 / total
-        speed = current / diff
-        elapsed_time = round(diff) * 1000
-        time_to_completion = round((total - current) / speed) * 1000
-        estimated_total_time = elapsed_time + time_to_completion
-
-        elapsed_time = TimeFormatter(milliseconds=elapsed_time)
-        estimated_total_time = TimeFormatter(milliseconds=estimated_total_time)
-
-        progress = "{0}{1}".format(
-            ''.join(["█" for i in range(math.floor(percentage / 5))]),
-            ''.join(["░" for i in range(20 - math.floor(percentage / 5))]))
-            
-        tmp = progress + mr.PROGRESS_BAR.format( 
-            round(percentage, 2),
-            humanbytes(current),
-            humanbytes(total),
-            humanbytes(speed),
-            # elapsed_time if elapsed_time != '' else "0 s",
-            estimated_total_time if estimated_total_time != '' else "0 s"
-        )
-        try:
-            await message.edit(
-                text="{}\n\n{}".format(ud_type, tmp),               
-                reply_markup=InlineKeyboardMarkup( [[
-                    InlineKeyboardButton("✖️ 𝙲𝙰𝙽𝙲𝙴𝙻 ✖️", callback_data="cancel")
-                    ]]
-                )
-            )
-        except:
-            pass
+from helper.membership import membership
 
 def humanbytes(size):
     # https://stackoverflow.com/a/49361727/4723940
@@ -79,14 +36,8 @@ def convert(seconds):
 async def not_subscribed(_, client, message):
    if not client.force_channel:
       return False
-   try:             
-      user = await client.get_chat_member(client.force_channel, message.from_user.id)
-   except UserNotParticipant:
-      pass
-   else:
-      if user.status != enums.ChatMemberStatus.BANNED:                       
-         return False 
-   return True
+   # Runs for every private message, so the answer is cached per user
+   return not await membership.is_member(client, client.force_channel, message.from_user.id)
          
 
 
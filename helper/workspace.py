@@ -0,0 +1,106 @@
+import os
+import shutil
+import logging
+import tempfile
+from contextlib import asynccontextmanager
+from config import TMP_DIR, MIN_FREE_SPACE
+
+logger = logging.getLogger(__name__)
+
+OWNER_FILE = ".owner"
+# Subdirectory for files named by the user
+OUTPUT_DIR = "out"
+
+
+class DiskQuotaExceeded(Exception):
+    pass
+
+
+class Workspace:
+
+    def __init__(self, path, reserved):
+        self.dir = path
+        self.reserved = reserved
+
+    def path(self, name):
+        # Everything a job writes stays inside its own directory
+        return os.path.join(self.dir, os.path.basename(name) or "file")
+
+    def output(self, name):
+        # A user-chosen name lives apart from the job's own files, so naming a
+        # file "thumb.jpg" or ".owner" cannot replace them
+        name = os.path.basename(name)
+        if name in ("", ".", ".."):
+            name = "file"
+        out = os.path.join(self.dir, OUTPUT_DIR)
+        os.makedirs(out, exist_ok=True)
+        return os.path.join(out, name)
+
+
+class WorkspaceManager:
+    # Each rename job gets its own directory under TMP_DIR so parallel jobs
+    # never share a download or thumbnail path. Space is reserved up front
+    # against what is actually free on disk, minus what running jobs have
+    # already claimed.
+
+    def __init__(self, root, min_free):
+        self.root = root
+        self.min_free = min_free
+        self.reserved = 0
+        os.makedirs(root, exist_ok=True)
+
+    def free_space(self):
+        return shutil.disk_usage(self.root).free - self.reserved - self.min_free
+
+    def cleanup_orphans(self):
+        # Job dirs whose owning process is gone were left behind by a crash
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if self._owner_alive(path):
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.warning(f"could not remove {path}: {e}")
+        if removed:
+            logger.info(f"removed {removed} orphaned entries from {self.root}")
+        return removed
+
+    @staticmethod
+    def _owner_alive(path):
+        try:
+            with open(os.path.join(path, OWNER_FILE)) as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return False
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @asynccontextmanager
+    async def job(self, job_id, size=0):
+        if size and size > self.free_space():
+            raise DiskQuotaExceeded(f"need {size} bytes, only {max(self.free_space(), 0)} free")
+        self.reserved += size
+        path = tempfile.mkdtemp(prefix=f"job{job_id}-", dir=self.root)
+        try:
+            with open(os.path.join(path, OWNER_FILE), "w") as f:
+                f.write(str(os.getpid()))
+            yield Workspace(path, size)
+        finally:
+            self.reserved -= size
+            shutil.rmtree(path, ignore_errors=True)
+
+
+workspaces = WorkspaceManager(TMP_DIR, MIN_FREE_SPACE)
@@ -24,12 +24,33 @@ License Link : https://github.com/LazyDeveloperr/Gangster-Baby-Renamer-BOT/blob/
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from helper.utils import not_subscribed 
+from helper.membership import membership
 
 @Client.on_message(filters.private & filters.create(not_subscribed))
 async def is_not_subscribed(client, message):
     buttons = [[ InlineKeyboardButton(text="📢𝙹𝚘𝚒𝚗 𝙼𝚢 𝚄𝚙𝚍𝚊𝚝𝚎 𝙲𝚑𝚊𝚗𝚗𝚎𝚕📢", url=client.invitelink) ]]
     text = "**𝚂𝙾𝚁𝚁𝚈 𝙳𝚄𝙳𝙴 𝚈𝙾𝚄'VE 𝙽𝙾𝚃 𝙹𝙾𝙸𝙽𝙳 𝙼𝚈 𝙲𝙷𝙰𝙽𝙽𝙴𝙻 😔. 𝙿𝙻𝙴𝙰𝚂𝙴 𝙹𝙾𝙸𝙽 𝙼𝚈 𝙲𝙷𝙰𝙽𝙽𝙴𝙻 𝚃𝙾 𝚄𝚂𝙴 𝚃𝙷𝙸𝚂 𝙱𝙾𝚃 🙏 **"
     await message.reply_text(text=text, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _is_force_channel(client, chat):
+    # FORCE_SUB may be given as a chat id or as a username
+    channel = str(client.force_channel)
+    if channel.lstrip("-").isdigit():
+        return chat.id == int(channel)
+    return bool(chat.username) and chat.username.lower() == channel.lstrip("@").lower()
+
+
+@Client.on_chat_member_updated()
+async def fsub_member_updated(client, update):
+    # Someone joined, left or was banned; the bot gets these for chats it is
+    # admin of, which the force-sub channel must be. Their next message
+    # checks membership again instead of trusting the cached answer.
+    if not client.force_channel or not _is_force_channel(client, update.chat):
+        return
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user:
+        membership.invalidate(member.user.id)
           
 
 
@@ -0,0 +1,199 @@
+import os
+import re
+import string
+import asyncio
+import logging
+from pyrogram import Client, filters
+from helper.database import db
+from helper.scheduler import scheduler, QueueFull
+from helper.thumbs import fetch_thumb
+from helper.workspace import workspaces
+from plugins.cb_data import rename_job, enqueue_rename, _safe_name
+from config import JOB_BACKEND, JOB_POLL, USER_QUEUE
+
+logger = logging.getLogger(__name__)
+
+BATCH_HELP = """**Send a naming template to start a batch.**
+
+Example:- `/batch video {title} S01E{n:02} {quality}.{ext}`
+
+• `{n}` - position of the file in the batch (1, 2, 3...)
+• `{title}` - original name without episode, quality and year
+• `{quality}` - quality found in the original name (720p, 1080p...)
+• `{name}` - original name without extension
+• `{ext}` - original extension
+
+The first word can be `document`, `video` or `audio` (default document).
+Then send your files and use /done, or /cancel_batch to stop."""
+
+QUALITY = re.compile(r"\b(\d{3,4}p|4k)\b", re.I)
+TITLE_END = re.compile(r"\b(s\d{1,2}e\d{1,3}|s\d{1,2}|e\d{1,3}|\d{3,4}p|4k|(19|20)\d{2})\b", re.I)
+PADDING = re.compile(r"0?[1-4]d?")
+# Longest file name most file systems accept
+MAX_NAME = 255
+
+# user id -> open batch
+batches = {}
+
+
+class Batch:
+
+    def __init__(self, kind, template):
+        self.kind = kind
+        self.template = template
+        self.files = []
+
+
+class _Formatter(string.Formatter):
+    # Plain names only, no attribute or index lookups from user templates.
+    # Format specs are limited to zero padding like {n:02}, anything else
+    # (e.g. a huge width) could make the bot build gigantic strings.
+    def get_field(self, field_name, args, kwargs):
+        if not field_name.isidentifier():
+            raise KeyError(field_name)
+        return super().get_field(field_name, args, kwargs)
+
+    def convert_field(self, value, conversion):
+        if conversion is not None:
+            raise ValueError(f"conversion !{conversion} is not supported")
+        return value
+
+    def format_field(self, value, format_spec):
+        if format_spec and not (isinstance(value, int) and PADDING.fullmatch(format_spec)):
+            raise ValueError(f"format {format_spec!r} is not supported, only padding like 02")
+        return super().format_field(value, format_spec)
+
+
+def _fields(file_name, n):
+    stem, _, ext = file_name.rpartition(".") if "." in file_name else (file_name, "", "")
+    clean = re.sub(r"[._]+", " ", stem).strip()
+    quality = QUALITY.search(clean)
+    # release tags like [Group] or (2019) are never part of the title
+    title = re.sub(r"\[[^\]]*\]|\([^)]*\)", " ", clean).strip()
+    title_end = TITLE_END.search(title)
+    if title_end and title_end.start():
+        title = title[:title_end.start()]
+    return dict(
+        n=n,
+        name=stem,
+        title=title.strip(" -") or clean,
+        quality=quality.group(1) if quality else "",
+        ext=ext or "mkv"
+    )
+
+
+def render_name(template, file_name, n):
+    name = _Formatter().format(template, **_fields(file_name, n))
+    name = re.sub(r"\s+", " ", name)
+    name = _safe_name(re.sub(r"\s+\.", ".", name))
+    if len(name) > MAX_NAME:
+        stem, ext = os.path.splitext(name)
+        ext = ext if len(ext) < 16 else ""
+        name = stem[:MAX_NAME - len(ext)].rstrip() + ext
+    return name
+
+
+def _batch_name(batch, src, n):
+    media = getattr(src, src.media.value)
+    return render_name(batch.template, media.file_name or f"file.{'mp4' if batch.kind == 'video' else 'mkv'}", n)
+
+
+def _in_batch(_, __, message):
+    return message.from_user is not None and message.from_user.id in batches
+
+
+@Client.on_message(filters.private & filters.command("batch"))
+async def start_batch(client, message):
+    args = message.text.split(None, 1)[1] if len(message.command) > 1 else ""
+    kind = "document"
+    first = args.split(None, 1)[0].lower() if args else ""
+    if first in ("document", "video", "audio"):
+        kind = first
+        args = args.split(None, 1)[1] if " " in args.strip() else ""
+    if not args:
+        return await message.reply_text(BATCH_HELP)
+    try:
+        render_name(args, "Example.S01E01.720p.mkv", 1)
+    except (KeyError, ValueError, IndexError) as e:
+        return await message.reply_text(f"❌ Bad template: `{e}`\n\n{BATCH_HELP}")
+    batches[message.from_user.id] = Batch(kind, args)
+    await message.reply_text(f"**Batch started** ({kind}).\n\nSend me the files now and use /done when finished.")
+
+
+# Group -1 runs before rename_start, so files sent during a batch are
+# collected instead of getting the single-file rename prompt
+@Client.on_message(filters.private & (filters.document | filters.audio | filters.video) & filters.create(_in_batch), group=-1)
+async def collect_batch(client, message):
+    batches[message.from_user.id].files.append(message)
+    message.stop_propagation()
+
+
+@Client.on_message(filters.private & filters.command("cancel_batch"))
+async def cancel_batch(client, message):
+    if batches.pop(message.from_user.id, None):
+        await message.reply_text("**Batch cancelled.**")
+    else:
+        await message.reply_text("😔**No batch running.**")
+
+
+@Client.on_message(filters.private & filters.command("done"))
+async def finish_batch(client, message):
+    batch = batches.pop(message.from_user.id, None)
+    if not batch:
+        return await message.reply_text("😔**No batch running.** Start one with /batch")
+    if not batch.files:
+        return await message.reply_text("😔**No files received, batch cancelled.**")
+    batch.files.sort(key=lambda m: m.id)
+    status = await message.reply_text(f"⏳ Batch of `{len(batch.files)}` files queued.")
+    if JOB_BACKEND == "mongo":
+        return asyncio.create_task(_queue_batch(message.from_user.id, batch, status))
+    asyncio.create_task(_run_batch(client, message.from_user.id, batch, status))
+
+
+async def _queue_batch(user_id, batch, status):
+    # JOB_BACKEND=mongo: every file becomes a job in the shared queue and
+    # each posts its own progress message from the worker. Like _run_batch it
+    # keeps at most USER_QUEUE of them waiting at a time.
+    queued = 0
+    for n, src in enumerate(batch.files, 1):
+        while await db.count_jobs("queued", user_id) >= USER_QUEUE:
+            await asyncio.sleep(JOB_POLL)
+        try:
+            await enqueue_rename(user_id, None, src, batch.kind, _batch_name(batch, src, n))
+        except QueueFull:
+            await status.edit(f"⏳ The bot is busy, only `{queued}` of `{len(batch.files)}` files were queued.")
+            return
+        queued += 1
+
+
+async def _run_batch(client, user_id, batch, status):
+    # The thumbnail is looked up and fetched once and shared by every job
+    async with workspaces.job(status.id) as ws:
+        t_id = await db.get_thumbnail(user_id)
+        thumb = None
+        if t_id:
+            try:
+                thumb = await fetch_thumb(client, t_id, ws.path("thumb.jpg"))
+            except Exception as e:
+                logger.warning(f"batch thumbnail for {user_id} failed: {e}")
+        jobs = []
+        for n, src in enumerate(batch.files, 1):
+            # Feed the queue as earlier files finish, so a big batch neither
+            # hits the user's cap nor fills MAX_QUEUE for everyone else
+            while scheduler.queued_for(user_id) >= USER_QUEUE:
+                waiting = [job for job in jobs if not job.done.is_set()]
+                if waiting:
+                    await waiting[0].done.wait()
+                else:
+                    # The queue is full of the user's single-file renames
+                    await asyncio.sleep(1)
+            try:
+                jobs.append(await scheduler.submit(user_id, rename_job, client, None, src, batch.kind, _batch_name(batch, src, n), thumb=thumb))
+            except QueueFull:
+                await status.edit(f"⏳ The bot is busy, only `{len(jobs)}` of `{len(batch.files)}` files were queued.")
+                break
+        await asyncio.gather(*(job.done.wait() for job in jobs))
+    try:
+        await status.edit(f"✅ Batch finished: `{len(jobs)}` files processed.")
+    except Exception:
+        pass
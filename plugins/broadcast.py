@@ -21,16 +21,13 @@ Repo Link : https://github.com/LazyDeveloperr/Gangster-Baby-Renamer-BOT
 License Link : https://github.com/LazyDeveloperr/Gangster-Baby-Renamer-BOT/blob/main/LICENSE
 """
 
-import os
-import time
-import asyncio 
 import logging 
-import datetime
 from config import ADMIN
 from helper.database import db
 from pyrogram.types import Message
 from pyrogram import Client, filters
-from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, PeerIdInvalid
+from helper.broadcast import start_job
+from helper.metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -43,45 +40,17 @@ async def get_stats(bot :Client, message: Message):
 
 @Client.on_message(filters.command("broadcast") & filters.user(ADMIN) & filters.reply)
 async def broadcast_handler(bot: Client, m: Message):
-    all_users = await db.get_all_users()
     broadcast_msg = m.reply_to_message
+    metrics.inc("broadcasts_total")
     sts_msg = await m.reply_text("broadcast started !") 
-    done = 0
-    failed = 0
-    success = 0
-    start_time = time.time()
     total_users = await db.total_users_count()
-    async for user in all_users:
-        sts = await send_msg(user['_id'], broadcast_msg)
-        if sts == 200:
-           success += 1
-        else:
-           failed += 1
-        if sts == 400:
-           await db.delete_user(user['_id'])
-        done += 1
-        if not done % 20:
-           await sts_msg.edit(f"Broadcast in progress:\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nFailed: {failed}")
-    completed_in = datetime.timedelta(seconds=int(time.time() - start_time))
-    await sts_msg.edit(f"Broadcast Completed:\nCompleted in `{completed_in}`.\n\nTotal Users {total_users}\nCompleted: {done} / {total_users}\nSuccess: {success}\nFailed: {failed}")
-           
-async def send_msg(user_id, message):
-    try:
-        await message.copy(chat_id=int(user_id))
-        return 200
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return send_msg(user_id, message)
-    except InputUserDeactivated:
-        logger.info(f"{user_id} : deactivated")
-        return 400
-    except UserIsBlocked:
-        logger.info(f"{user_id} : blocked the bot")
-        return 400
-    except PeerIdInvalid:
-        logger.info(f"{user_id} : user id invalid")
-        return 400
-    except Exception as e:
-        logger.error(f"{user_id} : {e}")
-        return 500
- 
+    job = await db.create_broadcast(
+        from_chat_id=broadcast_msg.chat.id,
+        message_id=broadcast_msg.id,
+        status_chat_id=sts_msg.chat.id,
+        status_message_id=sts_msg.id,
+        total=total_users
+    )
+    # Runs on its own so a shutdown can stop it and save its progress; the
+    # task is returned for callers that wait on it
+    return start_job(bot, job)
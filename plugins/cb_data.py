@@ -1,16 +1,27 @@
-from helper.utils import progress_for_pyrogram
+from helper.progress import Progress
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
-from hachoir.metadata import extractMetadata
-from hachoir.parser import createParser
 from helper.database import db
+from helper.scheduler import scheduler, QueueFull, UserQueueFull, current_job
+from helper.workspace import workspaces, DiskQuotaExceeded
+from helper.metrics import metrics, JOB_BUCKETS
+from helper.transfer import stream_upload, send_uploaded, parallel_download, upload_file
+from helper.probe import message_meta, resolve_meta
+from helper.thumbs import fetch_thumb
+from helper.dedup import jobs_index
+from helper.tracing import trace_job, span
+from config import STREAM_UPLOADS, DOWNLOAD_PARALLELISM, PARALLEL_MIN_SIZE, JOB_BACKEND, JOB_LEASE, MAX_QUEUE, USER_QUEUE, DEDUP_TTL
+from bson import ObjectId
 from pyrogram.enums import MessageMediaType
 import os
 import time
-from PIL import Image
+import asyncio
 
-TMP_DIR = "ren_tmp"
-os.makedirs(TMP_DIR, exist_ok=True)
+
+LOOKUP = object()
+
+BUSY = "⏳ The bot is busy right now, please try again in a few minutes."
+USER_BUSY = "⏳ You already have too many files waiting, please send this one again when some of them are done."
 
 
 def _safe_name(name: str) -> str:
@@ -19,37 +30,15 @@ def _safe_name(name: str) -> str:
     return name or "file"
 
 
-async def _extract_meta(path: str):
-    width = height = duration = None
-    try:
-        metadata = extractMetadata(createParser(path))
-        if metadata:
-            if metadata.has("duration"):
-                duration = int(metadata.get("duration").seconds)
-            if metadata.has("width"):
-                width = int(metadata.get("width"))
-            if metadata.has("height"):
-                height = int(metadata.get("height"))
-    except Exception:
-        pass
-    return width, height, duration
-
-
-async def _prepare_thumb(client: Client, user_id: int) -> str | None:
+async def _prepare_thumb(client: Client, user_id: int, ws, t_id=LOOKUP) -> str | None:
     # Download user's saved thumbnail (if any) and ensure it meets Telegram limits
-    t_id = await db.get_thumbnail(user_id)
+    if t_id is LOOKUP:
+        t_id = await db.get_thumbnail(user_id)
     if not t_id:
         return None
-    path = os.path.join(TMP_DIR, f"thumb_{user_id}.jpg")
+    path = ws.path("thumb.jpg")
     try:
-        await client.download_media(t_id, file_name=path)
-        # convert to JPEG, <= 320px, <= 200KB
-        im = Image.open(path).convert("RGB")
-        im.thumbnail((320, 320))
-        im.save(path, "JPEG", quality=85, optimize=True)
-        if os.path.getsize(path) > 200_000:
-            im.save(path, "JPEG", quality=70, optimize=True)
-        return path
+        return await fetch_thumb(client, t_id, path)
     except Exception:
         try:
             if os.path.exists(path):
@@ -78,51 +67,56 @@ def _parse_new_name(from_text: str) -> str | None:
     return None
 
 
-# ✅ Cusbooneysi: Progress bar function cusub
-async def custom_progress_bar(current, total, status_message, start_time):
-    now = time.time()
-    diff = now - start_time
-    if diff == 0:
-        diff = 0.1
-    percentage = current * 100 / total
-    speed = current / diff
-    eta = (total - current) / speed
-    elapsed_time = round(diff)
-
-    # Samee progress bar
-    filled_blocks = int(percentage // 10)
-    bar = "[" + "◾" * filled_blocks + "◽" * (10 - filled_blocks) + "]"
-
-    # Format size
-    def human_readable_size(size):
-        if size < 1024:
-            return f"{size}B"
-        elif size < 1024**2:
-            return f"{size/1024:.2f}KB"
-        elif size < 1024**3:
-            return f"{size/(1024**2):.2f}MB"
-        else:
-            return f"{size/(1024**3):.2f}GB"
-
-    text = (
-        f"⚠️Please wait...\n\n"
-        f"{bar} \n"
-        f"{percentage:.1f}%\n"
-        f"{human_readable_size(current)} of {human_readable_size(total)}\n"
-        f"Speed: {human_readable_size(speed)}/s\n"
-        f"ETA: {int(eta)}s"
-    )
+@Client.on_callback_query(filters.regex("^cancel$"))
+async def cancel(bot, update):
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+
+
+def _cancel_markup(job_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✖️ 𝙲𝙰𝙽𝙲𝙴𝙻 ✖️", callback_data=f"cancel_{job_id}")
+    ]])
+
 
+@Client.on_callback_query(filters.regex(r"^cancel_(\w+)$"))
+async def cancel_job(bot, update):
+    job_id = update.matches[0].group(1)
+    if JOB_BACKEND == "mongo" and ObjectId.is_valid(job_id):
+        return await _cancel_queued(update, ObjectId(job_id))
+    job = scheduler.get(int(job_id)) if job_id.isdigit() else None
+    if job is None or job.user_id != update.from_user.id:
+        await update.answer("This task has already finished.", show_alert=True)
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        return
+    await update.answer("Cancelling...")
+    # Waits until the transfer is stopped and its files are removed
+    await scheduler.cancel(job)
     try:
-        await status_message.edit(text)
+        await update.message.edit_text("❌ **Cancelled.**")
     except Exception:
         pass
 
 
-@Client.on_callback_query(filters.regex("^cancel$"))
-async def cancel(bot, update):
+async def _cancel_queued(update, job_id):
+    job = await db.cancel_job(job_id, update.from_user.id)
+    if job is None:
+        await update.answer("This task has already finished.", show_alert=True)
+        return
+    await update.answer("Cancelling...")
+    # A running job is stopped by its worker at the next heartbeat
+    for _ in range(JOB_LEASE):
+        found = await db.get_job(job_id)
+        if not found or found['status'] != "running":
+            break
+        await asyncio.sleep(1)
     try:
-        await update.message.delete()
+        await update.message.edit_text("❌ **Cancelled.**")
     except Exception:
         pass
 
@@ -142,6 +136,7 @@ async def ask_new_name(client, query):
 @Client.on_callback_query(filters.regex("^upload_(document|video|audio)$"))
 async def do_upload(client: Client, query):
     kind = query.data.split("_", 1)[1]
+    metrics.inc("rename_requests_total", kind=kind)
     msg = query.message
     src = msg.reply_to_message
     if not src:
@@ -155,66 +150,225 @@ async def do_upload(client: Client, query):
         new_name = media.file_name or f"file.{('mp4' if kind=='video' else 'bin')}"
     new_name = _safe_name(new_name)
 
-    status = await msg.edit_text("⚠️Please wait...\n\n[◽◽◽◽◽◽◽◽◽◽]\n0.0%")
-    c_time = time.time()
+    thumb_id = await db.get_thumbnail(msg.chat.id)
+    if await _send_by_file_id(client, msg, src, media, kind, new_name, thumb_id):
+        return
+
+    key = jobs_index.key(media, kind, new_name, thumb_id)
+    await _dispatch(client, query.from_user.id, msg, src, kind, new_name, key)
+
+
+async def _dispatch(client: Client, user_id: int, msg, src, kind: str, new_name: str, key):
+    # Re-send an identical rename that finished recently, wait for one that
+    # is still running, or queue a new job
+    file_id = jobs_index.recent(key)
+    if file_id:
+        if await _send_cached(client, msg, src, file_id, new_name):
+            metrics.inc("rename_jobs_total", path="dedup")
+            return
+        jobs_index.forget(key)
+    running = jobs_index.inflight(key)
+    if running is not None:
+        asyncio.create_task(_wait_for_duplicate(client, user_id, msg, src, kind, new_name, key, running))
+        return
+    if JOB_BACKEND == "mongo":
+        return await _enqueue(client, user_id, msg, src, kind, new_name, key)
 
-    dl_path = await client.download_media(
-        src,
-        file_name=os.path.join(TMP_DIR, "src"),
-        progress=custom_progress_bar,
-        progress_args=(status, c_time)
+    future = jobs_index.begin(key)
+    try:
+        # The thumbnail in the key is the one the job must use, even if the
+        # user changes it while the job waits
+        job = await scheduler.submit(user_id, rename_job, client, msg, src, kind, new_name, thumb_id=key[3], key=key)
+    except QueueFull as e:
+        jobs_index.release(key, future)
+        return await msg.edit_text(USER_BUSY if isinstance(e, UserQueueFull) else BUSY)
+    # Also covers a job cancelled before rename_job got to run
+    job.add_done_callback(lambda _: jobs_index.release(key, future))
+    position = scheduler.position(job)
+    if position is not None:
+        try:
+            await msg.edit_text(
+                f"⏳ Added to queue.\n\nPosition: `{position + 1}`\n\nYour file will be processed soon.",
+                reply_markup=_cancel_markup(job.id)
+            )
+        except Exception:
+            pass
+
+
+async def _enqueue(client: Client, user_id: int, msg, src, kind: str, new_name: str, key):
+    # JOB_BACKEND=mongo: the job goes to the shared queue for worker.py, and
+    # identical results come from whichever worker finished them
+    file_id = await db.recent_job_result(list(key), DEDUP_TTL)
+    if file_id and await _send_cached(client, msg, src, file_id, new_name):
+        metrics.inc("rename_jobs_total", path="dedup")
+        return
+    try:
+        job = await enqueue_rename(user_id, msg, src, kind, new_name, key)
+    except QueueFull as e:
+        return await msg.edit_text(USER_BUSY if isinstance(e, UserQueueFull) else BUSY)
+    position = await db.job_position(job)
+    try:
+        await msg.edit_text(
+            f"⏳ Added to queue.\n\nPosition: `{position + 1}`\n\nYour file will be processed soon.",
+            reply_markup=_cancel_markup(job['_id'])
+        )
+    except Exception:
+        pass
+
+
+async def enqueue_rename(user_id: int, msg, src, kind: str, new_name: str, key=None):
+    # Workers fetch both messages again by id. Raises QueueFull like
+    # scheduler.submit when the queue or the user's share of it is full.
+    if await db.count_jobs("queued") >= MAX_QUEUE:
+        raise QueueFull()
+    if await db.count_jobs("queued", user_id) >= USER_QUEUE:
+        raise UserQueueFull()
+    # The thumbnail is settled here: /delthumb and new thumbnails update the
+    # bot's user cache, not the workers'
+    thumb_id = key[3] if key else await db.get_thumbnail(user_id)
+    return await db.enqueue_job(
+        user_id=int(user_id),
+        chat_id=src.chat.id,
+        message_id=src.id,
+        prompt_id=msg.id if msg else None,
+        kind=kind,
+        new_name=new_name,
+        thumb_id=thumb_id,
+        key=list(key) if key else None
     )
 
-    base, ext = os.path.splitext(dl_path)
-    if not os.path.splitext(new_name)[1] and ext:
-        new_name = new_name + ext
-    file_path = os.path.join(TMP_DIR, new_name)
+
+async def run_queued(client: Client, doc):
+    # worker.py side of a job from enqueue_rename
+    src = await client.get_messages(doc['chat_id'], doc['message_id'])
+    if src.empty or not src.media:
+        return None
+    msg = await client.get_messages(doc['chat_id'], doc['prompt_id']) if doc['prompt_id'] else None
+    if msg is not None and msg.empty:
+        msg = None
+    return await rename_job(client, msg, src, doc['kind'], doc['new_name'], thumb_id=doc.get('thumb_id', LOOKUP))
+
+
+async def _wait_for_duplicate(client: Client, user_id: int, msg, src, kind: str, new_name: str, key, running):
     try:
-        os.replace(dl_path, file_path)
+        await msg.edit_text("⏳ This file is already being renamed, you will get it as soon as it is done.")
     except Exception:
-        file_path = dl_path
+        pass
+    # A failed or cancelled job leaves no result, and _dispatch queues our own
+    await asyncio.shield(running)
+    await _dispatch(client, user_id, msg, src, kind, new_name, key)
+
+
+async def _send_by_file_id(client: Client, msg, src, media, kind: str, new_name: str, thumb_id) -> bool:
+    # Telegram keeps the file name and thumbnail of a file re-sent by file_id,
+    # so this only works when neither of them has to change.
+    if src.media.value != kind or media.file_name != new_name or thumb_id:
+        return False
+    if not await _send_cached(client, msg, src, media.file_id, new_name):
+        return False
+    metrics.inc("rename_jobs_total", path="file_id")
+    return True
 
-    ph_path = await _prepare_thumb(client, msg.chat.id)
-    width = height = duration = None
-    if kind in ("video", "audio"):
-        w, h, d = await _extract_meta(file_path)
-        width, height, duration = w, h, d
 
+async def _send_cached(client: Client, msg, src, file_id: str, new_name: str) -> bool:
     try:
-        await status.edit("⚠️__**Please wait...**__\n__Processing file upload....__")
-        if kind == "document":
-            await client.send_document(
-                msg.chat.id,
-                document=file_path,
-                caption=new_name,
-                thumb=ph_path,
-                progress=progress_for_pyrogram,
-                progress_args=("⚠️Please wait...\n\nUploading...", status, c_time),
-                reply_to_message_id=src.id
-            )
-        elif kind == "video":
-            await client.send_video(
-                msg.chat.id,
-                video=file_path,
-                caption=new_name,
-                thumb=ph_path,
-                width=width,
-                height=height,
-                duration=duration,
-                supports_streaming=True,
-                progress=progress_for_pyrogram,
-                progress_args=("⚠️Please wait...\n\nUploading...", status, c_time),
-                reply_to_message_id=src.id
-            )
-        else:
-            await client.send_audio(
-                msg.chat.id,
-                audio=file_path,
+        await client.send_cached_media(
+            msg.chat.id,
+            file_id,
+            caption=new_name,
+            reply_to_message_id=src.id
+        )
+    except Exception:
+        return False
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+    return True
+
+
+async def _new_status(msg, src):
+    # Batch jobs have no prompt message of their own to take over
+    text = "⚠️Please wait...\n\n[◽◽◽◽◽◽◽◽◽◽]\n0.0%"
+    if msg is None:
+        return await src.reply_text(text, quote=True)
+    return await msg.edit_text(text)
+
+
+async def rename_job(client: Client, msg, src, kind: str, new_name: str, thumb=LOOKUP, thumb_id=LOOKUP, key=None):
+    # thumb: a ready thumbnail path (or None) when the caller already has it
+    # thumb_id: the user's thumbnail file_id (or None) when it is already known
+    # key: jobs_index entry that waits for the file this job produces
+    # Returns the file_id of the renamed file, or None if it was not sent
+    media = getattr(src, src.media.value)
+    # Files that need nothing from the local copy (documents, or media whose
+    # attributes Telegram already gave us) are piped straight through
+    meta = message_meta(src, kind)
+    stream = STREAM_UPLOADS and meta is not None and bool(media.file_size)
+    metrics.inc("rename_jobs_total", path="stream" if stream else "download")
+    if stream and kind != "document":
+        metrics.inc("media_meta_total", source="message")
+    job = current_job.get()
+    queued = time.time() - job.created if job else 0
+    with trace_job(job.id if job else src.id, src.chat.id, new_name, media.file_size or 0, queued) as trace:
+        if job:
+            job.trace = trace
+        sent = None
+        result = "failed"
+        try:
+            async with workspaces.job(src.id, 0 if stream else media.file_size or 0) as ws:
+                status = await _new_status(msg, src)
+                if thumb is LOOKUP:
+                    with span("thumb"):
+                        ph_path = await _prepare_thumb(client, src.chat.id, ws, thumb_id)
+                else:
+                    ph_path = thumb
+                if stream:
+                    sent = await _run_stream(client, status, src, media, kind, new_name, ph_path, meta)
+                else:
+                    sent = await _run_pipeline(client, status, src, kind, new_name, ws, ph_path)
+        except DiskQuotaExceeded:
+            result = "no_space"
+            text = "⏳ Not enough free disk space right now, please try again later."
+            try:
+                await (msg.edit_text(text) if msg else src.reply_text(text, quote=True))
+            except Exception:
+                pass
+        except asyncio.CancelledError:
+            result = "cancelled"
+            raise
+        finally:
+            file_id = getattr(sent, sent.media.value).file_id if sent and sent.media else None
+            if key is not None:
+                jobs_index.finish(key, file_id)
+            if file_id:
+                result = "done"
+            metrics.inc("rename_results_total", result=result)
+            trace.finish(result)
+            metrics.observe("rename_job_seconds", trace.total, JOB_BUCKETS, path="stream" if stream else "download")
+    return file_id
+
+
+async def _run_stream(client: Client, status, src, media, kind: str, new_name: str, ph_path, meta):
+    progress = Progress(status, "⚠️Please wait...\n\nUploading...")
+    try:
+        try:
+            with span("stream", bytes=media.file_size):
+                file = await stream_upload(client, src, new_name, media.file_size, progress=progress.update)
+        finally:
+            await progress.close()
+        with span("send"):
+            sent = await send_uploaded(
+                client,
+                src.chat.id,
+                kind,
+                file,
+                new_name,
                 caption=new_name,
                 thumb=ph_path,
-                duration=duration,
-                progress=progress_for_pyrogram,
-                progress_args=("⚠️Please wait...\n\nUploading...", status, c_time),
+                width=meta[0],
+                height=meta[1],
+                duration=meta[2],
                 reply_to_message_id=src.id
             )
     except Exception as e:
@@ -227,14 +381,66 @@ async def do_upload(client: Client, query):
             await status.delete()
         except Exception:
             pass
+        return sent
+
+
+async def _run_pipeline(client: Client, status, src, kind: str, new_name: str, ws, ph_path):
+    progress = Progress(status, "⚠️Please wait...\n\nDownloading...")
+    try:
+        media = getattr(src, src.media.value)
+        with span("download", bytes=media.file_size or 0):
+            if DOWNLOAD_PARALLELISM > 1 and (media.file_size or 0) >= PARALLEL_MIN_SIZE:
+                dl_path = await parallel_download(client, src, ws.path("src"), media.file_size, progress=progress.update)
+            else:
+                dl_path = await client.download_media(src, file_name=ws.path("src"), progress=progress.update)
+                metrics.inc("transfer_bytes_total", media.file_size or 0, direction="download")
     finally:
+        await progress.close()
+
+    base, ext = os.path.splitext(dl_path)
+    if not os.path.splitext(new_name)[1] and ext:
+        new_name = new_name + ext
+    file_path = ws.output(new_name)
+    with span("rename"):
+        try:
+            os.replace(dl_path, file_path)
+        except Exception:
+            file_path = dl_path
+
+    width = height = duration = None
+    if kind in ("video", "audio"):
+        with span("meta"):
+            width, height, duration = await resolve_meta(src, kind, file_path)
+
+    progress = Progress(status, "⚠️Please wait...\n\nUploading...")
+    try:
+        await status.edit("⚠️__**Please wait...**__\n__Processing file upload....__")
+        with span("upload", bytes=os.path.getsize(file_path)):
+            file = await upload_file(client, file_path, new_name, progress=progress.update)
+        with span("send"):
+            sent = await send_uploaded(
+                client,
+                src.chat.id,
+                kind,
+                file,
+                new_name,
+                caption=new_name,
+                thumb=ph_path,
+                width=width,
+                height=height,
+                duration=duration,
+                reply_to_message_id=src.id
+            )
+    except Exception as e:
+        await progress.close()
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            await status.edit(f"❌ Upload failed: `{e}`")
         except Exception:
             pass
+    else:
+        await progress.close()
         try:
-            if ph_path and os.path.exists(ph_path):
-                os.remove(ph_path)
+            await status.delete()
         except Exception:
             pass
+        return sent
@@ -35,8 +35,7 @@ from config import START_PIC, FLOOD, ADMIN
 @Client.on_message(filters.private & filters.command(["start"]))
 async def start(client, message):
     user = message.from_user
-    if not await db.is_user_exist(user.id):
-        await db.add_user(user.id)             
+    await db.add_user(user.id)
     txt=f"👋 Hello Developer {user.mention} \n\nI am an Advance file Renamer and file Converter BOT with permanent and custom thumbnail support.\n\nSend me any video or document !"
     button=InlineKeyboardMarkup([[
         InlineKeyboardButton("😈 Developer 😈", callback_data='dev')
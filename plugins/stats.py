@@ -0,0 +1,73 @@
+import datetime
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from config import ADMIN, JOB_BACKEND
+from helper.metrics import metrics
+from helper.scheduler import scheduler
+from helper.database import db
+from helper.tracing import slowest
+from helper.utils import humanbytes
+
+
+@Client.on_message(filters.command("stats") & filters.user(ADMIN))
+async def bot_stats(bot: Client, message: Message):
+    fast = metrics.get("rename_jobs_total", path="file_id")
+    dedup = metrics.get("rename_jobs_total", path="dedup")
+    full = metrics.get("rename_jobs_total", path="download")
+    stream = metrics.get("rename_jobs_total", path="stream")
+    sent = metrics.get("progress_updates_total", result="sent")
+    suppressed = metrics.total("progress_updates_total") - sent
+    hits = metrics.get("user_cache_total", result="hit")
+    misses = metrics.get("user_cache_total", result="miss")
+    from_message = metrics.get("media_meta_total", source="message")
+    probed = metrics.get("media_meta_total", source="probe")
+    if JOB_BACKEND == "mongo":
+        running, queued = await db.count_jobs("running"), await db.count_jobs("queued")
+    else:
+        running, queued = scheduler.active, scheduler.queued
+    text = (
+        "📊 **Rename stats**\n\n"
+        f"Re-sent by file_id: `{fast}`\n"
+        f"Re-sent from an identical job: `{dedup}`\n"
+        f"Downloaded and re-uploaded: `{full}`\n"
+        f"Streamed: `{stream}`\n\n"
+        f"Progress edits sent: `{sent}`\n"
+        f"Progress edits suppressed: `{suppressed}`\n\n"
+        f"User cache hits: `{hits}`\n"
+        f"User cache misses: `{misses}`\n\n"
+        f"Metadata taken from Telegram: `{from_message}`\n"
+        f"Metadata probed from file: `{probed}`\n\n"
+        f"Running: `{running}`\n"
+        f"Queued: `{queued}`"
+    )
+    await message.reply_text(text)
+
+
+def _format_trace(n, trace):
+    stages = []
+    for s in trace['spans']:
+        extra = ", ".join(f"{k} {v}" for k, v in s.items() if k not in ("stage", "offset", "duration", "bytes"))
+        stages.append(f"{s['stage']} {s['duration']:.1f}s" + (f" ({extra})" if extra else ""))
+    text = (
+        f"**{n}.** `{trace['name']}` - {trace['total']:.1f}s\n"
+        f"{trace['result']}, {humanbytes(trace['size'])}, user `{trace['user_id']}`, job `{trace['job_id']}`\n"
+        f"{' · '.join(stages)}"
+    )
+    if trace.get('profile'):
+        # Innermost frame of the hottest sampled stacks
+        hot = [f"{line.rsplit(' ', 1)[0].rsplit(';', 1)[-1]} ×{line.rsplit(' ', 1)[1]}" for line in trace['profile'][:3]]
+        text += "\nprofile: " + " · ".join(hot)
+    return text
+
+
+@Client.on_message(filters.command("slowjobs") & filters.user(ADMIN))
+async def slow_jobs(bot: Client, message: Message):
+    limit = min(int(message.command[1]), 20) if len(message.command) > 1 and message.command[1].isdigit() else 5
+    if JOB_BACKEND == "mongo":
+        traces = await db.slow_jobs(limit, datetime.datetime.utcnow() - datetime.timedelta(days=1))
+    else:
+        traces = slowest(limit)
+    if not traces:
+        return await message.reply_text("No finished renames recorded yet.")
+    text = "🐢 **Slowest recent renames**\n\n" + "\n\n".join(_format_trace(n, t) for n, t in enumerate(traces, 1))
+    await message.reply_text(text[:4096])
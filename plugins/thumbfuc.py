@@ -1,5 +1,7 @@
 from pyrogram import Client, filters
 from helper.database import db
+from helper.thumbs import thumbs, store_thumb
+from helper.workspace import workspaces
 
 @Client.on_message(filters.private & filters.command(['viewthumb']))
 async def viewthumb(client, message):    
@@ -13,12 +15,26 @@ async def viewthumb(client, message):
 		
 @Client.on_message(filters.private & filters.command(['delthumb']))
 async def removethumb(client, message):
+    old = await db.get_thumbnail(message.from_user.id)
     await db.set_thumbnail(message.from_user.id, file_id=None)
+    if old:
+        thumbs.invalidate(old)
+        await db.delete_thumb(old)
     await message.reply_text("**Thumbnail deleted successfully**✅️")
 	
 @Client.on_message(filters.private & filters.photo)
 async def addthumbs(client, message):
     LazyDev = await message.reply_text("Please Wait ...")
-    await db.set_thumbnail(message.from_user.id, file_id=message.photo.file_id)                
+    old = await db.get_thumbnail(message.from_user.id)
+    file_id = message.photo.file_id
+    try:
+        async with workspaces.job(message.id) as ws:
+            meta = await store_thumb(client, file_id, ws.path("thumb.jpg"))
+    except Exception:
+        return await LazyDev.edit("😔**Sorry ! Could not process this picture, try another one.**")
+    await db.set_thumbnail(message.from_user.id, file_id=file_id, meta=meta)
+    if old and old != file_id:
+        thumbs.invalidate(old)
+        await db.delete_thumb(old)
     await LazyDev.edit("**Thumbnail saved successfully**✅️")
 	
@@ -1,4 +1,8 @@
+import asyncio
 from aiohttp import web
+from config import HEALTH_MAX_LAG, JOB_BACKEND
+from helper.database import db
+from helper.metrics import metrics
 
 routes = web.RouteTableDef()
 
@@ -7,7 +11,53 @@ async def root_route_handler(request):
     return web.json_response("LazyDeveloper")
 
 
-async def web_server():
+@routes.get("/metrics")
+async def metrics_handler(request):
+    if JOB_BACKEND == "mongo" and request.app.get("queue_gauges"):
+        await _queue_gauges()
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def _queue_gauges():
+    # The shared queue's size, read on scrape; the last values stay if Mongo
+    # does not answer in time
+    try:
+        queued, running = await asyncio.wait_for(
+            asyncio.gather(db.count_jobs("queued"), db.count_jobs("running")), timeout=2
+        )
+    except Exception:
+        return
+    metrics.set("rename_jobs_queued", queued)
+    metrics.set("rename_jobs_running", running)
+
+
+@routes.get("/healthz", allow_head=True)
+async def health_handler(request):
+    # Ready when Telegram is connected, Mongo answers, the loop is not stalled
+    # and, on worker.py, every job loop is still running
+    bot = request.app.get("bot")
+    checks = {"telegram": bool(bot and bot.is_connected)}
+    jobs = getattr(bot, "jobs", None)
+    if jobs is not None:
+        checks["jobs"] = jobs.alive
+    try:
+        await asyncio.wait_for(db.ping(), timeout=2)
+        checks["mongo"] = True
+    except Exception:
+        checks["mongo"] = False
+    lag = metrics.gauges.get(("event_loop_lag_last_seconds", ()), 0)
+    checks["event_loop"] = lag < HEALTH_MAX_LAG
+    ok = all(checks.values())
+    return web.json_response(
+        {"status": "ok" if ok else "unavailable", "checks": checks, "loop_lag": round(lag, 3)},
+        status=200 if ok else 503
+    )
+
+
+async def web_server(bot=None, queue_gauges=True):
+    # queue_gauges is off for worker.py, so the queue is counted only once
     web_app = web.Application(client_max_size=30000000)
+    web_app["bot"] = bot
+    web_app["queue_gauges"] = queue_gauges
     web_app.add_routes(routes)
     return web_app
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import logging.config
+from aiohttp import web
+from pyrogram import Client
+from config import API_ID, API_HASH, BOT_TOKEN, MAX_TRANSMISSIONS, WORKER_ID, WORKER_PORT, LOOP_LAG_INTERVAL, LOOP_LAG_WARN
+from helper.jobqueue import JobWorker
+from helper.workspace import workspaces
+from helper.database import db
+from helper.metrics import metrics, watch_loop_lag
+from helper import offload
+from plugins.cb_data import run_queued
+from plugins.web_support import web_server
+
+logging.config.fileConfig('logging.conf')
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger("pyrogram").setLevel(logging.ERROR)
+
+
+class Worker(Client):
+    # Rename worker for JOB_BACKEND=mongo: no handlers and no updates, it only
+    # takes jobs the bot put in the queue. Start as many as you need.
+
+    def __init__(self):
+        super().__init__(
+            name=f"worker-{WORKER_ID}",
+            api_id=API_ID,
+            api_hash=API_HASH,
+            bot_token=BOT_TOKEN,
+            in_memory=True,
+            no_updates=True,
+            sleep_threshold=5,
+            max_concurrent_transmissions=MAX_TRANSMISSIONS,
+        )
+        self.jobs = JobWorker(self, run_queued)
+        metrics.gauge("worker_jobs_running", lambda: self.jobs.running)
+
+    async def start(self):
+        await super().start()
+        await db.ensure_indexes()
+        workspaces.cleanup_orphans()
+        self.jobs.start()
+        self.lag_watchdog = asyncio.create_task(watch_loop_lag(LOOP_LAG_INTERVAL, LOOP_LAG_WARN))
+        # Transfer, FloodWait and job metrics of this worker
+        if WORKER_PORT:
+            app = web.AppRunner(await web_server(self, queue_gauges=False))
+            await app.setup()
+            await web.TCPSite(app, "0.0.0.0", WORKER_PORT).start()
+        logging.info(f"Worker {WORKER_ID} started")
+
+    async def stop(self, *args):
+        self.lag_watchdog.cancel()
+        await self.jobs.stop()
+        offload.shutdown()
+        await super().stop()
+        logging.info(f"Worker {WORKER_ID} stopped")
+
+
+worker = Worker()
+worker.run()